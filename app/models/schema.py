@@ -91,6 +91,7 @@ class VideoParams(BaseModel):
     bgm_volume: Optional[float] = 0.2
 
     subtitle_enabled: Optional[bool] = True
+    subtitle_mode: Optional[str] = "burn"  # burn, soft
     subtitle_position: Optional[str] = "bottom"  # top, bottom, center
     custom_position: float = 70.0
     font_name: Optional[str] = "STHeitiMedium.ttc"
@@ -0,0 +1,194 @@
+import os
+
+from loguru import logger
+from moviepy.video.tools.subtitles import file_to_subtitles
+from PIL import ImageFont
+
+from app.models.schema import VideoParams
+from app.services import ffmpeg
+from app.utils import utils
+
+burn = "burn"
+soft = "soft"
+# height of a subtitle line in font sizes
+line_height = 1.25
+
+
+def ass_color(color: str, alpha: int = 0) -> str:
+    # ASS colours are &HAABBGGRR, alpha 0 is opaque
+    color = (color or "#FFFFFF").lstrip("#")
+    if len(color) != 6:
+        color = "FFFFFF"
+    return f"&H{alpha:02X}{color[4:6]}{color[2:4]}{color[0:2]}".upper()
+
+
+def ass_time(seconds: float) -> str:
+    centiseconds = max(0, round(seconds * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def ass_text(text: str) -> str:
+    text = text.strip().replace("\\", "\\\\").replace("{", "\\{").replace("}", "\\}")
+    return text.replace("\r\n", "\n").replace("\n", "\\N")
+
+
+def font_name(params: VideoParams):
+    # libass looks fonts up by family name in fontsdir, not by file name
+    font_path = os.path.join(utils.font_dir(), params.font_name or "STHeitiMedium.ttc")
+    try:
+        return ImageFont.truetype(font_path, 10).getname()
+    except Exception as e:
+        logger.warning(f"failed to read font name from {font_path}: {str(e)}")
+        return "Arial", ""
+
+
+def _custom_margin(params: VideoParams, video_height: int, lines: int) -> int:
+    # same placement as the moviepy overlay: top edge at custom_position %
+    # of the space the wrapped lines leave free
+    text_height = lines * params.font_size * line_height
+    margin_v = (video_height - text_height) * (params.custom_position / 100)
+    return round(max(10, min(margin_v, video_height - text_height - 10)))
+
+
+def _wrap(text: str, params: VideoParams, video_width: int) -> str:
+    # the line breaks of the moviepy overlay, made explicit so libass keeps them
+    from app.services import video
+
+    font_path = os.path.join(utils.font_dir(), params.font_name or "STHeitiMedium.ttc")
+    try:
+        wrapped, _ = video.wrap_text(
+            text.strip(),
+            max_width=int(video_width * 0.9),
+            font=font_path,
+            fontsize=params.font_size,
+        )
+        return wrapped
+    except Exception as e:
+        logger.warning(f"failed to wrap subtitle with {font_path}: {str(e)}")
+        return text
+
+
+def _style(params: VideoParams, video_width: int, video_height: int) -> str:
+    family, font_style = font_name(params)
+    alignment = {"top": 8, "center": 5, "custom": 8}.get(params.subtitle_position, 2)
+    margin_v = round(video_height * 0.05)
+    if params.subtitle_position == "custom":
+        # events carry their own margin, this one is for a single line
+        margin_v = _custom_margin(params, video_height, 1)
+
+    background = params.text_background_color
+    border_style, outline_color = 1, ass_color(params.stroke_color)
+    if isinstance(background, str) and background.startswith("#"):
+        # opaque box behind the text, libass draws it with the outline colour
+        border_style, outline_color = 3, ass_color(background)
+
+    fields = {
+        "Name": "Default",
+        "Fontname": family,
+        "Fontsize": params.font_size,
+        "PrimaryColour": ass_color(params.text_fore_color),
+        "SecondaryColour": ass_color(params.text_fore_color),
+        "OutlineColour": outline_color,
+        "BackColour": ass_color("#000000", 0x80),
+        "Bold": -1 if "Bold" in (font_style or "") else 0,
+        "Italic": 0,
+        "Underline": 0,
+        "StrikeOut": 0,
+        "ScaleX": 100,
+        "ScaleY": 100,
+        "Spacing": 0,
+        "Angle": 0,
+        "BorderStyle": border_style,
+        "Outline": params.stroke_width,
+        "Shadow": 0,
+        "Alignment": alignment,
+        "MarginL": round(video_width * 0.05),
+        "MarginR": round(video_width * 0.05),
+        "MarginV": margin_v,
+        "Encoding": 1,
+    }
+    return (
+        f"Format: {', '.join(fields.keys())}\n"
+        f"Style: {','.join(str(v) for v in fields.values())}"
+    )
+
+
+def create(
+    subtitle_path: str,
+    params: VideoParams,
+    video_width: int,
+    video_height: int,
+    ass_path: str = "",
+) -> str:
+    """
+    Convert an srt file into an ASS file laid out on the output canvas with
+    the VideoParams styling, ready for the libass subtitles filter or muxing.
+    """
+    if not ass_path:
+        ass_path = f"{os.path.splitext(subtitle_path)[0]}.ass"
+
+    events = []
+    for (start, end), text in file_to_subtitles(subtitle_path, encoding="utf-8"):
+        margin_v = 0
+        if params.subtitle_position == "custom":
+            # the wrapped height decides how far down the text may start
+            text = _wrap(text, params, video_width)
+            margin_v = _custom_margin(params, video_height, text.count("\n") + 1)
+        events.append(
+            f"Dialogue: 0,{ass_time(start)},{ass_time(end)},Default,,0,0,{margin_v},,{ass_text(text)}"
+        )
+
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        "WrapStyle: 0",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        _style(params, video_width, video_height),
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+        *events,
+        "",
+    ]
+    with open(ass_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    logger.info(f"ass subtitle created: {ass_path}, {len(events)} events")
+    return ass_path
+
+
+def burn_filter(ass_path: str, offset: float = 0) -> str:
+    subtitle_filter = (
+        f"subtitles=filename={ffmpeg.escape_filter_value(ass_path.replace(os.sep, '/'))}"
+        f":fontsdir={ffmpeg.escape_filter_value(utils.font_dir().replace(os.sep, '/'))}"
+    )
+    if offset:
+        # a part of the timeline, shift it so the subtitle timing lines up
+        subtitle_filter = (
+            f"setpts=PTS+{offset:.3f}/TB,{subtitle_filter},setpts=PTS-STARTPTS"
+        )
+    return subtitle_filter
+
+
+def mux(video_file: str, ass_path: str) -> str:
+    """
+    Add the subtitles to a finished video as a soft track, without re-encoding.
+    """
+    temp_file = f"{video_file}.subs.mp4"
+    args = ["-i", video_file, "-i", ass_path, "-map", "0:v", "-map", "0:a?"]
+    # mp4 only carries mov_text, players show it as a selectable track
+    args += ["-map", "1:s", "-c:v", "copy", "-c:a", "copy", "-c:s", "mov_text"]
+    args += ["-movflags", "+faststart", temp_file]
+    try:
+        ffmpeg.run(args, desc="mux subtitles")
+        os.replace(temp_file, video_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return video_file
@@ -0,0 +1,102 @@
+import threading
+from typing import Callable, Dict, Tuple
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from app.config import config
+
+# provider => its session, every task and thread reuses the open connections
+_sessions: Dict[str, requests.Session] = {}
+# (provider, credentials...) => sdk client
+_clients: Dict[Tuple, object] = {}
+_lock = threading.Lock()
+
+
+def pool_size() -> int:
+    # connections kept open per host and provider
+    return max(1, int(config.app.get("http_pool_size", 10)))
+
+
+def timeout(connect: float, read: float) -> Tuple[float, float]:
+    """
+    (connect, read) timeout of a call, http_connect_timeout and
+    http_read_timeout override the defaults of every call site.
+    """
+    return (
+        float(config.app.get("http_connect_timeout", connect)),
+        float(config.app.get("http_read_timeout", read)),
+    )
+
+
+def session(provider: str) -> requests.Session:
+    """
+    The shared keep-alive session of a provider (pexels, pixabay, downloads...).
+    """
+    with _lock:
+        s = _sessions.get(provider)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size(), pool_maxsize=pool_size())
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+            _sessions[provider] = s
+            logger.debug(f"http session created: {provider}")
+        return s
+
+
+def httpx_client(connect: float = 30, read: float = 600):
+    # for the sdks built on httpx (openai), with the same pool settings
+    import httpx
+
+    connect, read = timeout(connect, read)
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=pool_size(), max_keepalive_connections=pool_size()
+        ),
+        timeout=httpx.Timeout(read, connect=connect),
+    )
+
+
+def client(provider: str, factory: Callable, *key):
+    """
+    One sdk client per provider and credentials (api key, base url...),
+    created by factory on first use and shared by all tasks after that.
+    """
+    cache_key = (provider, *key)
+    with _lock:
+        c = _clients.get(cache_key)
+    if c is not None:
+        return c
+    created = factory()
+    with _lock:
+        # another thread may have won the race, keep the first one
+        c = _clients.setdefault(cache_key, created)
+    if c is not created:
+        # the loser's connection pool would otherwise stay open
+        _close(created)
+        return c
+    logger.debug(f"client created: {provider}")
+    return c
+
+
+def _close(c):
+    close = getattr(c, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception as e:
+            logger.warning(f"failed to close client: {str(e)}")
+
+
+def close_all():
+    with _lock:
+        sessions = list(_sessions.values())
+        clients = list(_clients.values())
+        _sessions.clear()
+        _clients.clear()
+    for s in sessions:
+        s.close()
+    for c in clients:
+        _close(c)
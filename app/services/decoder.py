@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+from loguru import logger
+from moviepy import VideoFileClip
+
+from app.config import config
+from app.services import governor, metadata, processes
+
+# (path, output size) => idle readers, least recently used first
+_idle: "OrderedDict[Tuple, List[VideoFileClip]]" = OrderedDict()
+_leased: Dict[int, Tuple] = {}
+# reader => the task that leased it last, idle readers go with that task
+_owners: Dict[int, str] = {}
+_lock = threading.Lock()
+
+
+def _is_alive(clip: VideoFileClip) -> bool:
+    proc = getattr(clip.reader, "proc", None)
+    return proc is not None and proc.poll() is None
+
+
+def _close(clip: VideoFileClip):
+    try:
+        clip.close()
+    except Exception as e:
+        logger.warning(f"failed to close reader {clip.filename}: {str(e)}")
+
+
+def _trim(max_readers: int):
+    # only idle readers are evicted, a leased one is in the middle of a render
+    idle_count = sum(len(clips) for clips in _idle.values())
+    while idle_count > max_readers and _idle:
+        key, clips = next(iter(_idle.items()))
+        clip = clips.pop(0)
+        if not clips:
+            del _idle[key]
+        idle_count -= 1
+        _owners.pop(id(clip), None)
+        logger.debug(f"evict reader: {key[0]}")
+        _close(clip)
+
+
+def cover_size(width: int, height: int, video_width: int, video_height: int):
+    # smallest size with the source aspect ratio that fills the whole output
+    ratio = max(video_width / width, video_height / height)
+    return (
+        max(video_width, round(width * ratio)),
+        max(video_height, round(height * ratio)),
+    )
+
+
+def open_clip(video_path: str, video_size: Tuple[int, int]) -> VideoFileClip:
+    """
+    Open a video whose frames come out of ffmpeg already scaled to cover
+    video_size, the overflow is cut off in the middle with a plain array slice.
+    """
+    video_width, video_height = video_size
+    # a decoder is small next to an encoder, it does not hold a slot but it
+    # still waits (briefly, the task may be waiting on its own readers) for RAM
+    governor.wait_for_memory(f"decode {video_path}", timeout=30)
+    info = metadata.probe(video_path)
+    width, height = info["width"], info["height"]
+    if (width, height) == (video_width, video_height) or not width or not height:
+        return VideoFileClip(video_path, audio=False)
+
+    scaled_width, scaled_height = cover_size(width, height, video_width, video_height)
+    clip = VideoFileClip(
+        video_path, audio=False, target_resolution=(scaled_width, scaled_height)
+    )
+    if (scaled_width, scaled_height) != (video_width, video_height):
+        clip = clip.cropped(
+            x1=(scaled_width - video_width) // 2,
+            y1=(scaled_height - video_height) // 2,
+            width=video_width,
+            height=video_height,
+        )
+    return clip
+
+
+def acquire(video_path: str, video_size: Tuple[int, int]) -> VideoFileClip:
+    """
+    Lease a decoder for video_path, reusing an idle one when there is one.
+    Every subclip taken from the returned clip shares its ffmpeg reader, so
+    cuts played in order are served without seeking back.
+    """
+    key = (video_path, tuple(video_size))
+    clip = None
+    with _lock:
+        clips = _idle.get(key)
+        while clips and clip is None:
+            candidate = clips.pop()
+            if _is_alive(candidate):
+                clip = candidate
+            else:
+                _owners.pop(id(candidate), None)
+                _close(candidate)
+        if key in _idle and not _idle[key]:
+            del _idle[key]
+
+    if clip is None:
+        logger.info(f"open reader: {video_path}, size: {video_size}")
+        clip = open_clip(video_path, video_size)
+    else:
+        logger.debug(f"reuse reader: {video_path}")
+
+    with _lock:
+        _leased[id(clip)] = key
+        _owners[id(clip)] = processes.current_task()
+    return clip
+
+
+def release(clip: VideoFileClip):
+    with _lock:
+        key = _leased.pop(id(clip), None)
+        if key is None:
+            return
+        _idle.setdefault(key, []).append(clip)
+        _idle.move_to_end(key)
+        _trim(config.app.get("max_open_readers", 8))
+
+
+def close_task(task_id: str = ""):
+    """
+    Close the idle readers the task leased last, the readers of other tasks
+    running in this process stay in the pool.
+    """
+    task_id = task_id or processes.current_task()
+    clips = []
+    with _lock:
+        for key in list(_idle):
+            keep = []
+            for clip in _idle[key]:
+                if _owners.get(id(clip)) == task_id:
+                    _owners.pop(id(clip), None)
+                    clips.append(clip)
+                else:
+                    keep.append(clip)
+            if keep:
+                _idle[key] = keep
+            else:
+                del _idle[key]
+    for clip in clips:
+        _close(clip)
@@ -0,0 +1,225 @@
+import functools
+import json
+import os
+import re
+import shutil
+import subprocess
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.services import governor, processes
+
+
+def ffmpeg_exe() -> str:
+    ffmpeg_path = config.app.get("ffmpeg_path", "")
+    if ffmpeg_path and os.path.isfile(ffmpeg_path):
+        return ffmpeg_path
+
+    ffmpeg_path = os.environ.get("IMAGEIO_FFMPEG_EXE", "")
+    if ffmpeg_path and os.path.isfile(ffmpeg_path):
+        return ffmpeg_path
+
+    ffmpeg_path = shutil.which("ffmpeg")
+    if ffmpeg_path:
+        return ffmpeg_path
+
+    try:
+        # moviepy always ships with the imageio-ffmpeg static build
+        import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return "ffmpeg"
+
+
+@functools.lru_cache(maxsize=None)
+def has_filter(name: str) -> bool:
+    # builds without libass have no subtitles filter
+    cmd = [ffmpeg_exe(), "-hide_banner", "-filters"]
+    try:
+        result = subprocess.run(cmd, capture_output=True, timeout=60)
+    except Exception as e:
+        logger.warning(f"failed to list ffmpeg filters: {str(e)}")
+        return False
+    output = result.stdout.decode("utf-8", errors="ignore")
+    return re.search(rf"^\s*\S+\s+{re.escape(name)}\s", output, re.M) is not None
+
+
+def escape_filter_value(value: str) -> str:
+    # filter option level, then filtergraph level
+    for c in "\\':":
+        value = value.replace(c, "\\" + c)
+    for c in "\\'[],;":
+        value = value.replace(c, "\\" + c)
+    return value
+
+
+def ffprobe_exe() -> str:
+    # the static imageio-ffmpeg build has no ffprobe, look next to ffmpeg first
+    ffmpeg_path = ffmpeg_exe()
+    ffmpeg_dir, ffmpeg_name = os.path.split(ffmpeg_path)
+    if ffmpeg_dir and ffmpeg_name.lower().startswith("ffmpeg"):
+        ffprobe_path = os.path.join(ffmpeg_dir, ffmpeg_name.replace("ffmpeg", "ffprobe", 1))
+        if os.path.isfile(ffprobe_path):
+            return ffprobe_path
+    return shutil.which("ffprobe") or ""
+
+
+def _parse_fps(value: str) -> float:
+    try:
+        if "/" in value:
+            num, den = value.split("/", 1)
+            return float(num) / float(den) if float(den) else 0.0
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _probe_with_ffprobe(ffprobe_path: str, file_path: str) -> dict:
+    cmd = [
+        ffprobe_path,
+        "-v",
+        "error",
+        "-print_format",
+        "json",
+        "-show_format",
+        "-show_streams",
+        file_path,
+    ]
+    result = subprocess.run(cmd, capture_output=True, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"ffprobe failed: {result.stderr.decode('utf-8', errors='ignore').strip()}"
+        )
+    data = json.loads(result.stdout.decode("utf-8", errors="ignore") or "{}")
+
+    info = {
+        "duration": float(data.get("format", {}).get("duration") or 0),
+        "width": 0,
+        "height": 0,
+        "fps": 0.0,
+        "codec": "",
+        "has_video": False,
+        "has_audio": False,
+    }
+    for stream in data.get("streams", []):
+        codec_type = stream.get("codec_type")
+        if codec_type == "video" and not info["has_video"]:
+            info["has_video"] = True
+            info["width"] = int(stream.get("width") or 0)
+            info["height"] = int(stream.get("height") or 0)
+            info["fps"] = _parse_fps(stream.get("avg_frame_rate", "")) or _parse_fps(
+                stream.get("r_frame_rate", "")
+            )
+            info["codec"] = stream.get("codec_name", "")
+            # rotated phone footage reports the coded size
+            rotation = stream.get("tags", {}).get("rotate", "")
+            for side_data in stream.get("side_data_list", []):
+                if "rotation" in side_data:
+                    rotation = side_data["rotation"]
+            if str(rotation).lstrip("-") in ("90", "270"):
+                info["width"], info["height"] = info["height"], info["width"]
+            if not info["duration"]:
+                info["duration"] = float(stream.get("duration") or 0)
+        elif codec_type == "audio":
+            info["has_audio"] = True
+    return info
+
+
+def _probe_with_ffmpeg(file_path: str) -> dict:
+    cmd = [ffmpeg_exe(), "-hide_banner", "-nostdin", "-i", file_path]
+    result = subprocess.run(cmd, capture_output=True, timeout=60)
+    # ffmpeg exits with an error without an output file, the banner is all we need
+    output = result.stderr.decode("utf-8", errors="ignore")
+
+    info = {
+        "duration": 0.0,
+        "width": 0,
+        "height": 0,
+        "fps": 0.0,
+        "codec": "",
+        "has_video": False,
+        "has_audio": False,
+    }
+    match = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if match:
+        hours, minutes, seconds = match.groups()
+        info["duration"] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    for line in output.splitlines():
+        if "Stream #" not in line:
+            continue
+        if " Video: " in line and not info["has_video"]:
+            info["has_video"] = True
+            codec = re.search(r"Video:\s*([\w-]+)", line)
+            size = re.search(r",\s*(\d{2,5})x(\d{2,5})", line)
+            fps = re.search(r"([\d.]+)\s*fps", line) or re.search(r"([\d.]+)\s*tbr", line)
+            if codec:
+                info["codec"] = codec.group(1)
+            if size:
+                info["width"], info["height"] = int(size.group(1)), int(size.group(2))
+            if fps:
+                info["fps"] = float(fps.group(1))
+        elif " Audio: " in line:
+            info["has_audio"] = True
+
+    # rotated phone footage reports the coded size
+    rotation = re.search(r"rotation of (-?\d+(?:\.\d+)?) degrees", output)
+    if rotation and round(abs(float(rotation.group(1)))) in (90, 270):
+        info["width"], info["height"] = info["height"], info["width"]
+    return info
+
+
+def probe(file_path: str) -> dict:
+    """
+    Read duration, size, fps and codec of a media file without decoding it.
+    """
+    ffprobe_path = ffprobe_exe()
+    if ffprobe_path:
+        try:
+            return _probe_with_ffprobe(ffprobe_path, file_path)
+        except Exception as e:
+            logger.warning(f"ffprobe failed for {file_path}, fallback to ffmpeg: {str(e)}")
+    return _probe_with_ffmpeg(file_path)
+
+
+def keyframes(file_path: str) -> List[float]:
+    """
+    Timestamps of the keyframes of the first video stream, only keyframes
+    are decoded.
+    """
+    ffprobe_path = ffprobe_exe()
+    if ffprobe_path:
+        cmd = [ffprobe_path, "-v", "error", "-select_streams", "v:0"]
+        cmd += ["-skip_frame", "nokey", "-show_entries", "frame=pts_time"]
+        cmd += ["-of", "csv=p=0", file_path]
+        result = subprocess.run(cmd, capture_output=True, timeout=300)
+        output = result.stdout.decode("utf-8", errors="ignore")
+        return [float(v) for v in re.findall(r"^\s*(-?[\d.]+)", output, re.M)]
+
+    cmd = [ffmpeg_exe(), "-hide_banner", "-nostdin", "-skip_frame", "nokey"]
+    cmd += ["-i", file_path, "-map", "0:v:0", "-fps_mode", "passthrough"]
+    cmd += ["-vf", "showinfo", "-f", "null", "-"]
+    result = subprocess.run(cmd, capture_output=True, timeout=300)
+    output = result.stderr.decode("utf-8", errors="ignore")
+    return [float(v) for v in re.findall(r"pts_time:(-?[\d.]+)", output)]
+
+
+def run(args: List[str], desc: str = "ffmpeg"):
+    cmd = [ffmpeg_exe(), "-hide_banner", "-nostdin", "-y", *args]
+    logger.debug(f"{desc}: {subprocess.list2cmdline(cmd)}")
+    with governor.slot(desc):
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL
+        )
+        processes.register(proc)
+        try:
+            _, stderr = proc.communicate()
+        finally:
+            processes.unregister(proc)
+    if proc.returncode != 0:
+        error = stderr.decode("utf-8", errors="ignore").strip().splitlines()
+        raise RuntimeError(f"{desc} failed ({proc.returncode}): {' | '.join(error[-5:])}")
+    return proc.returncode
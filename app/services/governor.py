@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+try:
+    import fcntl
+except ImportError:  # windows, slots are only shared between threads
+    fcntl = None
+
+# one lock per slot, threads of this process never share a slot file
+_slot_locks = {}
+_lock = threading.Lock()
+# largest RSS seen for a single ffmpeg process, what the next launch is expected to need
+_peak_rss = 0
+
+poll_interval = 0.5
+
+
+def ram_limit() -> int:
+    # ffmpeg_ram_limit is in GB, 0 disables the RAM budget
+    return int(float(config.app.get("ffmpeg_ram_limit", 0) or 0) * 1024**3)
+
+
+def max_processes() -> int:
+    return max(1, int(config.app.get("max_ffmpeg_processes", 3)))
+
+
+def ffmpeg_rss():
+    """
+    Total and largest RSS of the ffmpeg processes running on this host,
+    whichever worker or task started them.
+    """
+    total, largest = 0, 0
+    for proc in psutil.process_iter(["name", "memory_info"]):
+        name = (proc.info.get("name") or "").lower()
+        memory = proc.info.get("memory_info")
+        if "ffmpeg" not in name or memory is None:
+            continue
+        total += memory.rss
+        largest = max(largest, memory.rss)
+    return total, largest
+
+
+def has_memory() -> bool:
+    global _peak_rss
+    limit = ram_limit()
+    if limit <= 0:
+        return True
+    total, largest = ffmpeg_rss()
+    _peak_rss = max(_peak_rss, largest)
+    if not total:
+        # nothing to wait for, the first process is always admitted
+        return True
+    needed = _peak_rss
+    return total + needed <= limit and psutil.virtual_memory().available > needed
+
+
+def wait_for_memory(desc: str = "ffmpeg", timeout: float = None) -> bool:
+    """
+    Block until the ffmpeg processes on this host leave room in the RAM
+    budget for one more. Gives up after timeout seconds and lets it start
+    anyway, so a task waiting on its own open decoders can not hang.
+    """
+    if timeout is None:
+        timeout = float(config.app.get("ffmpeg_memory_wait", 300))
+    started = time.monotonic()
+    waiting = False
+    while not has_memory():
+        if time.monotonic() - started > timeout:
+            logger.warning(f"{desc}: ffmpeg RAM budget still exceeded, starting anyway")
+            return False
+        if not waiting:
+            waiting = True
+            logger.info(f"{desc}: waiting for ffmpeg RAM budget")
+        time.sleep(poll_interval)
+    if waiting:
+        logger.info(f"{desc}: admitted after {time.monotonic() - started:.1f}s")
+    return True
+
+
+def _slot_path(index: int) -> str:
+    return os.path.join(utils.storage_dir("locks", create=True), f"ffmpeg-{index}.lock")
+
+
+def _try_slot(index: int):
+    with _lock:
+        thread_lock = _slot_locks.setdefault(index, threading.Lock())
+    if not thread_lock.acquire(blocking=False):
+        return None
+    if fcntl is None:
+        return thread_lock, None
+
+    handle = open(_slot_path(index), "a")
+    try:
+        # the lock file is what other worker processes and servers see
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        thread_lock.release()
+        return None
+    return thread_lock, handle
+
+
+def _release_slot(slot):
+    thread_lock, handle = slot
+    if handle is not None:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+    thread_lock.release()
+
+
+@contextmanager
+def slot(desc: str = "ffmpeg"):
+    """
+    Run an encoder under the host-wide budget: at most max_ffmpeg_processes
+    at a time (threads, pool workers and other servers alike) and only when
+    the measured RSS of the running ones leaves room within ffmpeg_ram_limit.
+    Work beyond the budget queues here instead of running the box out of RAM.
+    """
+    started = time.monotonic()
+    waiting = False
+    acquired = None
+    while acquired is None:
+        wait_for_memory(desc)
+        for index in range(max_processes()):
+            acquired = _try_slot(index)
+            if acquired is not None:
+                break
+        if acquired is None:
+            if not waiting:
+                waiting = True
+                logger.info(f"{desc}: all {max_processes()} ffmpeg slots are busy, queued")
+            time.sleep(poll_interval)
+    if waiting:
+        logger.info(f"{desc}: got an ffmpeg slot after {time.monotonic() - started:.1f}s")
+    try:
+        yield
+    finally:
+        _release_slot(acquired)
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import VideoAspect
+from app.services import ffmpeg, normalize, processes, video_cache
+from app.utils import utils
+
+# the clip ends zoomed in by this much per second, as the moviepy zoom did
+zoom_per_second = 0.03
+# zoompan crops whole pixels, working on a larger copy keeps the zoom smooth
+oversample = 2
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("image_videos", create=True)
+
+
+def image_key(image_path: str) -> str:
+    digest = hashlib.md5()
+    with open(image_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def video_path(image_path: str, clip_duration: float, video_aspect: VideoAspect) -> str:
+    aspect_tag = VideoAspect(video_aspect).value.replace(":", "x")
+    file_name = (
+        f"img-{image_key(image_path)}-{clip_duration:g}s-{aspect_tag}-"
+        f"{normalize.fps}fps-{normalize.profile}.mp4"
+    )
+    return os.path.join(cache_dir(), file_name)
+
+
+def zoom_filter(clip_duration: float, video_width: int, video_height: int) -> str:
+    frames = max(1, round(clip_duration * normalize.fps))
+    zoom = zoom_per_second * clip_duration
+    width, height = video_width * oversample, video_height * oversample
+    return (
+        f"scale={width}:{height}:force_original_aspect_ratio=increase,"
+        f"crop={width}:{height},"
+        f"zoompan=z='1+{zoom:.4f}*on/{frames}'"
+        f":x='iw/2-iw/zoom/2':y='ih/2-ih/zoom/2'"
+        f":d={frames}:s={video_width}x{video_height}:fps={normalize.fps},"
+        f"setsar=1,format=yuv420p"
+    )
+
+
+def image_to_video(
+    image_path: str, clip_duration: float, video_aspect: VideoAspect
+) -> str:
+    """
+    Turn an image into a clip slowly zooming into its centre, rendered by
+    ffmpeg's zoompan filter and cached by image content, duration and aspect.
+    """
+    output_path = video_path(image_path, clip_duration, video_aspect)
+    # pinned for the task before looking, a sweep can not take it away after
+    video_cache.use(output_path)
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        logger.info(f"image video already exists: {output_path}")
+        return output_path
+
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    threads = config.app.get("ffmpeg_threads_per_process", 2)
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp.mp4"
+    args = [
+        "-i",
+        image_path,
+        "-vf",
+        zoom_filter(clip_duration, video_width, video_height),
+        "-frames:v",
+        str(max(1, round(clip_duration * normalize.fps))),
+        "-an",
+        *normalize.encode_args(threads),
+        "-movflags",
+        "+faststart",
+        temp_path,
+    ]
+    try:
+        ffmpeg.run(args, desc="image to video")
+        os.replace(temp_path, output_path)
+        video_cache.added()
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logger.success(f"image video: {image_path} => {output_path}")
+    return output_path
+
+
+def images_to_videos(
+    image_paths: List[str], clip_duration: float, video_aspect: VideoAspect
+) -> Dict[str, str]:
+    """
+    Convert images side by side, at most max_ffmpeg_processes at a time.
+    Returns image path => video path for the ones that succeeded.
+    """
+    workers = max(1, int(config.app.get("max_ffmpeg_processes", 3)))
+    # the threads only wait on ffmpeg, they run under the caller's task
+    convert = processes.bind(image_to_video)
+
+    videos = {}
+    with ThreadPoolExecutor(max_workers=min(workers, len(image_paths) or 1)) as pool:
+        futures = {
+            image_path: pool.submit(convert, image_path, clip_duration, video_aspect)
+            for image_path in dict.fromkeys(image_paths)
+        }
+        for image_path, future in futures.items():
+            try:
+                videos[image_path] = future.result()
+            except Exception as e:
+                logger.warning(f"failed to convert image {image_path}: {str(e)}")
+    return videos
@@ -0,0 +1,157 @@
+import threading
+import time
+from typing import Dict, List
+
+from loguru import logger
+
+from app.config import config
+
+# published quotas, api_key_limits in the config overrides them:
+# requests per period (seconds) for each key
+default_limits = {
+    "pexels_api_keys": {"requests": 200, "period": 3600},
+    "pixabay_api_keys": {"requests": 100, "period": 60},
+}
+# statuses that mean this key is throttled or refused for now
+throttled_statuses = (403, 429)
+
+_lock = threading.Condition()
+# config key => api key => bucket
+_buckets: Dict[str, Dict[str, "Bucket"]] = {}
+
+
+class Bucket:
+    """
+    Token bucket of one api key: it refills at requests/period tokens per
+    second up to requests, and is empty while the key cools down.
+    """
+
+    def __init__(self, requests: int, period: float):
+        self.capacity = max(1, int(requests))
+        self.rate = self.capacity / max(1e-3, float(period))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.cooldown_until = 0.0
+        self.usage = {"requests": 0, "throttled": 0, "waited": 0.0}
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        # seconds until this key can take one more request
+        if now < self.cooldown_until:
+            return self.cooldown_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def _limits(cfg_key: str) -> dict:
+    limits = dict(default_limits.get(cfg_key, {"requests": 60, "period": 60}))
+    limits.update(config.app.get("api_key_limits", {}).get(cfg_key, {}))
+    return limits
+
+
+def _configured(cfg_key: str) -> List[str]:
+    api_keys = config.app.get(cfg_key)
+    if isinstance(api_keys, str):
+        api_keys = [api_keys]
+    return [k for k in (api_keys or []) if k]
+
+
+def _buckets_of(cfg_key: str) -> Dict[str, Bucket]:
+    # keys edited in the webui are picked up, the removed ones dropped
+    api_keys = _configured(cfg_key)
+    buckets = _buckets.setdefault(cfg_key, {})
+    limits = _limits(cfg_key)
+    for api_key in api_keys:
+        if api_key not in buckets:
+            buckets[api_key] = Bucket(limits["requests"], limits["period"])
+    for api_key in list(buckets):
+        if api_key not in api_keys:
+            del buckets[api_key]
+    return buckets
+
+
+def count(cfg_key: str) -> int:
+    return len(_configured(cfg_key))
+
+
+def acquire(cfg_key: str) -> str:
+    """
+    Take a request token from the key with the most left, waiting (up to
+    api_key_wait seconds) when every key is spent or cooling down. Raises
+    ValueError when none is configured and RuntimeError after waiting.
+    """
+    max_wait = float(config.app.get("api_key_wait", 30))
+    started = time.monotonic()
+    with _lock:
+        while True:
+            buckets = _buckets_of(cfg_key)
+            if not buckets:
+                raise ValueError(f"{cfg_key} is not set")
+            now = time.monotonic()
+            for bucket in buckets.values():
+                bucket.refill(now)
+            api_key, bucket = min(
+                buckets.items(), key=lambda kv: (kv[1].wait_time(now), -kv[1].tokens)
+            )
+            wait = bucket.wait_time(now)
+            if wait <= 0:
+                bucket.tokens -= 1
+                bucket.usage["requests"] += 1
+                bucket.usage["waited"] += now - started
+                return api_key
+            if now + wait - started > max_wait:
+                raise RuntimeError(
+                    f"all {cfg_key} are rate limited, next one free in {wait:.0f}s"
+                )
+            logger.info(f"all {cfg_key} are rate limited, waiting {wait:.1f}s")
+            _lock.wait(timeout=wait)
+
+
+def report(cfg_key: str, api_key: str, status_code: int, retry_after: str = "") -> bool:
+    """
+    Tell the scheduler how a request went. A throttled or refused key cools
+    down (for Retry-After seconds when the provider says), returns False.
+    """
+    if status_code not in throttled_statuses:
+        return True
+    try:
+        cooldown = float(retry_after)
+    except (TypeError, ValueError):
+        cooldown = float(config.app.get("api_key_cooldown", 60))
+    with _lock:
+        bucket = _buckets_of(cfg_key).get(api_key)
+        if bucket is not None:
+            bucket.cooldown_until = time.monotonic() + cooldown
+            bucket.tokens = 0
+            bucket.usage["throttled"] += 1
+        _lock.notify_all()
+    logger.warning(
+        f"{cfg_key} key ...{api_key[-4:]} got {status_code}, cooling down for {cooldown:.0f}s"
+    )
+    return False
+
+
+def usage(cfg_key: str = "") -> dict:
+    """
+    Per key counters (requests, throttled, seconds waited) and the tokens
+    left, keys are shown by their last 4 characters.
+    """
+    now = time.monotonic()
+    with _lock:
+        cfg_keys = [cfg_key] if cfg_key else list(_buckets)
+        result = {}
+        for name in cfg_keys:
+            result[name] = {}
+            for api_key, bucket in _buckets_of(name).items():
+                bucket.refill(now)
+                result[name][f"...{api_key[-4:]}"] = {
+                    **bucket.usage,
+                    "waited": round(bucket.usage["waited"], 3),
+                    "tokens": round(bucket.tokens, 2),
+                    "cooldown": round(max(0.0, bucket.cooldown_until - now), 1),
+                }
+        return result
@@ -9,6 +9,7 @@ from openai import AzureOpenAI, OpenAI
 from openai.types.chat import ChatCompletion
 
 from app.config import config
+from app.services import clients
 
 _max_retries = 5
 
@@ -172,9 +173,7 @@ def _generate_response(prompt: str) -> str:
                 return generated_text
 
             if llm_provider == "cloudflare":
-                import requests
-
-                response = requests.post(
+                response = clients.session("cloudflare").post(
                     f"https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/{model_name}",
                     headers={"Authorization": f"Bearer {api_key}"},
                     json={
@@ -186,22 +185,24 @@ def _generate_response(prompt: str) -> str:
                             {"role": "user", "content": prompt},
                         ]
                     },
+                    timeout=clients.timeout(30, 600),
                 )
                 result = response.json()
                 logger.info(result)
                 return result["result"]["response"]
 
             if llm_provider == "ernie":
-                import requests
-
                 params = {
                     "grant_type": "client_credentials",
                     "client_id": api_key,
                     "client_secret": secret_key,
                 }
                 access_token = (
-                    requests.post(
-                        "https://aip.baidubce.com/oauth/2.0/token", params=params
+                    clients.session("ernie")
+                    .post(
+                        "https://aip.baidubce.com/oauth/2.0/token",
+                        params=params,
+                        timeout=clients.timeout(30, 60),
                     )
                     .json()
                     .get("access_token")
@@ -221,21 +222,39 @@ def _generate_response(prompt: str) -> str:
                 )
                 headers = {"Content-Type": "application/json"}
 
-                response = requests.request(
-                    "POST", url, headers=headers, data=payload
+                response = clients.session("ernie").request(
+                    "POST",
+                    url,
+                    headers=headers,
+                    data=payload,
+                    timeout=clients.timeout(30, 600),
                 ).json()
                 return response.get("result")
 
+            # one client per provider and key, its connections stay open between prompts
             if llm_provider == "azure":
-                client = AzureOpenAI(
-                    api_key=api_key,
-                    api_version=api_version,
-                    azure_endpoint=base_url,
+                client = clients.client(
+                    llm_provider,
+                    lambda: AzureOpenAI(
+                        api_key=api_key,
+                        api_version=api_version,
+                        azure_endpoint=base_url,
+                        http_client=clients.httpx_client(),
+                    ),
+                    api_key,
+                    base_url,
+                    api_version,
                 )
             else:
-                client = OpenAI(
-                    api_key=api_key,
-                    base_url=base_url,
+                client = clients.client(
+                    llm_provider,
+                    lambda: OpenAI(
+                        api_key=api_key,
+                        base_url=base_url,
+                        http_client=clients.httpx_client(),
+                    ),
+                    api_key,
+                    base_url,
                 )
 
             response = client.chat.completions.create(
@@ -1,62 +1,109 @@
 import os
 import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from contextlib import contextmanager
 from typing import List
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse
 
 import requests
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
 from app.models.schema import MaterialInfo, VideoAspect, VideoConcatMode
+from app.services import (
+    clients,
+    keys,
+    metadata,
+    processes,
+    renditions,
+    search_cache,
+    video_cache,
+)
 from app.utils import utils
 
-requested_count = 0
+try:
+    import fcntl
+except ImportError:  # windows, downloads are only serialized between threads
+    fcntl = None
+
+# host => how many downloads from it may run at once
+_host_slots = {}
+_host_lock = threading.Lock()
+_path_locks = {}
 
 
 def get_api_key(cfg_key: str):
-    api_keys = config.app.get(cfg_key)
-    if not api_keys:
+    if not keys.count(cfg_key):
         raise ValueError(
             f"\n\n##### {cfg_key} is not set #####\n\nPlease set it in the config.toml file: {config.config_file}\n\n"
             f"{utils.to_json(config.app)}"
         )
-
-    # if only one key is provided, return it
-    if isinstance(api_keys, str):
-        return api_keys
-
-    global requested_count
-    requested_count += 1
-    return api_keys[requested_count % len(api_keys)]
+    # the key with the most requests left in its quota, waits when all are spent
+    return keys.acquire(cfg_key)
+
+
+def _search_get(provider: str, cfg_key: str, build_request):
+    """
+    GET a search with the scheduled api key, build_request(api_key) gives the
+    url and headers. A throttled key cools down and the next one is tried.
+    """
+    for _ in range(max(1, keys.count(cfg_key))):
+        api_key = get_api_key(cfg_key)
+        query_url, headers = build_request(api_key)
+        logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+        r = clients.session(provider).get(
+            query_url,
+            headers=headers,
+            proxies=config.proxy,
+            verify=False,
+            timeout=clients.timeout(30, 60),
+        )
+        if keys.report(cfg_key, api_key, r.status_code, r.headers.get("Retry-After")):
+            break
+    return r
 
 
 def search_videos_pexels(
     search_term: str,
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
+    page: int = 1,
 ) -> List[MaterialInfo]:
     aspect = VideoAspect(video_aspect)
     video_orientation = aspect.name
     video_width, video_height = aspect.to_resolution()
-    api_key = get_api_key("pexels_api_keys")
-    headers = {
-        "Authorization": api_key,
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    }
     # Build URL
-    params = {"query": search_term, "per_page": 20, "orientation": video_orientation}
+    params = {
+        "query": search_term,
+        "per_page": 20,
+        "orientation": video_orientation,
+        "page": page,
+    }
+    cache_key = search_cache.key(
+        "pexels",
+        search_term,
+        video_orientation,
+        minimum_duration,
+        params["per_page"],
+        page,
+    )
+    cached = search_cache.get("pexels", cache_key)
+    if cached is not None:
+        return cached
     query_url = f"https://api.pexels.com/videos/search?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+
+    def build_request(api_key):
+        headers = {
+            "Authorization": api_key,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+        }
+        return query_url, headers
 
     try:
-        r = requests.get(
-            query_url,
-            headers=headers,
-            proxies=config.proxy,
-            verify=False,
-            timeout=(30, 60),
-        )
+        r = _search_get("pexels", "pexels_api_keys", build_request)
         response = r.json()
         video_items = []
         if "videos" not in response:
@@ -69,18 +116,30 @@ def search_videos_pexels(
             # check if video has desired minimum duration
             if duration < minimum_duration:
                 continue
-            video_files = v["video_files"]
-            # loop through each url to determine the best quality
-            for video in video_files:
-                w = int(video["width"])
-                h = int(video["height"])
-                if w == video_width and h == video_height:
-                    item = MaterialInfo()
-                    item.provider = "pexels"
-                    item.url = video["link"]
-                    item.duration = duration
-                    video_items.append(item)
-                    break
+            # the smallest file that still covers the output after cropping
+            video = renditions.choose(
+                [
+                    {
+                        "url": f.get("link"),
+                        "width": f.get("width"),
+                        "height": f.get("height"),
+                        "size": f.get("size"),
+                        "fps": f.get("fps"),
+                    }
+                    for f in v["video_files"]
+                    if f.get("file_type", "video/mp4") == "video/mp4"
+                ],
+                video_width,
+                video_height,
+                duration,
+            )
+            if video:
+                item = MaterialInfo()
+                item.provider = "pexels"
+                item.url = video["url"]
+                item.duration = duration
+                video_items.append(item)
+        search_cache.put("pexels", cache_key, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -92,26 +151,34 @@ def search_videos_pixabay(
     search_term: str,
     minimum_duration: int,
     video_aspect: VideoAspect = VideoAspect.portrait,
+    page: int = 1,
 ) -> List[MaterialInfo]:
     aspect = VideoAspect(video_aspect)
 
     video_width, video_height = aspect.to_resolution()
 
-    api_key = get_api_key("pixabay_api_keys")
-    # Build URL
-    params = {
-        "q": search_term,
-        "video_type": "all",  # Accepted values: "all", "film", "animation"
-        "per_page": 50,
-        "key": api_key,
-    }
-    query_url = f"https://pixabay.com/api/videos/?{urlencode(params)}"
-    logger.info(f"searching videos: {query_url}, with proxies: {config.proxy}")
+    per_page = 50
+    # pixabay has no orientation filter, the width decides
+    cache_key = search_cache.key(
+        "pixabay", search_term, aspect.name, minimum_duration, per_page, page
+    )
+    cached = search_cache.get("pixabay", cache_key)
+    if cached is not None:
+        return cached
+
+    def build_request(api_key):
+        # Build URL
+        params = {
+            "q": search_term,
+            "video_type": "all",  # Accepted values: "all", "film", "animation"
+            "per_page": per_page,
+            "page": page,
+            "key": api_key,
+        }
+        return f"https://pixabay.com/api/videos/?{urlencode(params)}", {}
 
     try:
-        r = requests.get(
-            query_url, proxies=config.proxy, verify=False, timeout=(30, 60)
-        )
+        r = _search_get("pixabay", "pixabay_api_keys", build_request)
         response = r.json()
         video_items = []
         if "hits" not in response:
@@ -124,19 +191,18 @@ def search_videos_pixabay(
             # check if video has desired minimum duration
             if duration < minimum_duration:
                 continue
-            video_files = v["videos"]
-            # loop through each url to determine the best quality
-            for video_type in video_files:
-                video = video_files[video_type]
-                w = int(video["width"])
-                # h = int(video["height"])
-                if w >= video_width:
-                    item = MaterialInfo()
-                    item.provider = "pixabay"
-                    item.url = video["url"]
-                    item.duration = duration
-                    video_items.append(item)
-                    break
+            # large, medium, small and tiny, pick the smallest file that
+            # still covers the output after cropping
+            video = renditions.choose(
+                list(v["videos"].values()), video_width, video_height, duration
+            )
+            if video:
+                item = MaterialInfo()
+                item.provider = "pixabay"
+                item.url = video["url"]
+                item.duration = duration
+                video_items.append(item)
+        search_cache.put("pixabay", cache_key, video_items)
         return video_items
     except Exception as e:
         logger.error(f"search videos failed: {str(e)}")
@@ -144,7 +210,58 @@ def search_videos_pixabay(
     return []
 
 
-def save_video(video_url: str, save_dir: str = "") -> str:
+def _content_length(response: requests.Response, offset: int):
+    # the full size of the file, from the range or the plain length
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    length = response.headers.get("Content-Length")
+    if length is None:
+        return None
+    return int(length) + offset
+
+
+def _stream(video_url: str, part_path: str, headers: dict, cancel_event=None):
+    """
+    Append the rest of video_url to part_path chunk by chunk, asking only for
+    the missing bytes when part of it is already there. Returns the full
+    size of the file when the server tells it, False when cancelled.
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    request_headers = dict(headers)
+    if offset:
+        request_headers["Range"] = f"bytes={offset}-"
+    chunk_size = int(config.app.get("download_chunk_size", 1024 * 1024))
+
+    with clients.session("downloads").get(
+        video_url,
+        headers=request_headers,
+        proxies=config.proxy,
+        verify=False,
+        timeout=clients.timeout(60, 240),
+        stream=True,
+    ) as r:
+        if r.status_code == 416 and offset:
+            # nothing left to send, the part file is already complete
+            return _content_length(r, 0)
+        r.raise_for_status()
+        if offset and r.status_code != 206:
+            logger.info(f"server ignored the range, downloading again: {video_url}")
+            offset = 0
+        elif offset:
+            logger.info(f"resuming download at {offset} bytes: {video_url}")
+        expected_size = _content_length(r, offset)
+
+        with open(part_path, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                if cancel_event is not None and cancel_event.is_set():
+                    # the part file is kept, a later download resumes it
+                    return False
+                f.write(chunk)
+    return expected_size
+
+
+def save_video(video_url: str, save_dir: str = "", cancel_event=None) -> str:
     if not save_dir:
         save_dir = utils.storage_dir("cache_videos")
 
@@ -155,6 +272,8 @@ def save_video(video_url: str, save_dir: str = "") -> str:
     url_hash = utils.md5(url_without_query)
     video_id = f"vid-{url_hash}"
     video_path = f"{save_dir}/{video_id}.mp4"
+    # pinned for the task before looking, a sweep can not take it away after
+    video_cache.use(video_path)
 
     # if video already exists, return the path
     if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
@@ -165,33 +284,228 @@ def save_video(video_url: str, save_dir: str = "") -> str:
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
     }
 
-    # if video does not exist, download it
-    with open(video_path, "wb") as f:
-        f.write(
-            requests.get(
-                video_url,
-                headers=headers,
-                proxies=config.proxy,
-                verify=False,
-                timeout=(60, 240),
-            ).content
-        )
+    # if video does not exist, download it next to the final path and only
+    # move it there once it is complete, a broken download is never cached
+    part_path = f"{video_path}.part"
+    with _path_lock(video_path):
+        if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+            return video_path
 
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+        retries = max(1, int(config.app.get("download_retries", 3)))
+        for attempt in range(1, retries + 1):
+            try:
+                expected_size = _stream(video_url, part_path, headers, cancel_event)
+                break
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"download interrupted, retrying ({attempt}/{retries}): {str(e)}")
+        if expected_size is False:
+            logger.info(f"download cancelled: {video_url}")
+            return ""
+
+        size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if expected_size is not None and size != expected_size:
+            # resuming appends to it, a mismatch means it can not be trusted
+            os.remove(part_path)
+            logger.warning(f"incomplete download: {video_url}, {size} of {expected_size} bytes")
+            return ""
+
+        if size > 0:
+            try:
+                # one probe, stored in the index for every later stage
+                info = metadata.probe(part_path)
+                if info["duration"] <= 0 or info["fps"] <= 0:
+                    raise ValueError(f"duration: {info['duration']}, fps: {info['fps']}")
+            except Exception as e:
+                logger.warning(f"invalid video file: {video_path} => {str(e)}")
+                metadata.forget(part_path)
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                return ""
+            os.replace(part_path, video_path)
+            metadata.move(part_path, video_path)
+            video_cache.added()
+            return video_path
+    return ""
+
+
+# provider => search function, config key of its api keys
+search_providers = {
+    "pexels": (search_videos_pexels, "pexels_api_keys"),
+    "pixabay": (search_videos_pixabay, "pixabay_api_keys"),
+}
+
+
+@contextmanager
+def _path_lock(path: str):
+    """
+    Two tasks asking for the same material download it once: threads of
+    this process wait on a lock, other worker processes on an flock of its
+    part file, so no two of them append to it at the same time.
+    """
+    with _host_lock:
+        lock = _path_locks.setdefault(path, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        part_path = f"{path}.part"
+        while True:
+            if os.path.exists(path):
+                # finished meanwhile, there is nothing left to write
+                yield
+                return
+            handle = open(part_path, "ab")
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                current = os.stat(part_path).st_ino == os.fstat(handle.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                break
+            # the holder renamed or removed the part file, lock the new one
+            handle.close()
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                return video_path
-        except Exception as e:
+            yield
+        finally:
             try:
-                os.remove(video_path)
-            except Exception:
+                # opened just as the holder finished, no download to resume
+                if os.path.exists(path) and os.path.getsize(part_path) == 0:
+                    os.remove(part_path)
+            except FileNotFoundError:
                 pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
-    return ""
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            handle.close()
+
+
+def _host_slot(url: str) -> threading.BoundedSemaphore:
+    host = urlparse(url).netloc.lower()
+    with _host_lock:
+        if host not in _host_slots:
+            limit = max(1, int(config.app.get("max_downloads_per_host", 2)))
+            _host_slots[host] = threading.BoundedSemaphore(limit)
+        return _host_slots[host]
+
+
+def _download(video_url: str, save_dir: str, cancel_event: threading.Event) -> str:
+    # every task shares the per-host limit, providers throttle by client
+    with _host_slot(video_url):
+        if cancel_event.is_set():
+            return ""
+        return save_video(
+            video_url=video_url, save_dir=save_dir, cancel_event=cancel_event
+        )
+
+
+def search_sources(source: str) -> List[str]:
+    # the task's provider first, the others only when asked for and configured
+    sources = [source]
+    if config.app.get("search_all_providers", False):
+        sources += [
+            name
+            for name, (_, cfg_key) in search_providers.items()
+            if name != source and config.app.get(cfg_key)
+        ]
+    return sources
+
+
+def search_materials(
+    search_terms: List[str],
+    source: str = "pexels",
+    minimum_duration: int = 5,
+    video_aspect: VideoAspect = VideoAspect.portrait,
+    required_duration: float = 0.0,
+    max_clip_duration: int = 5,
+) -> List[MaterialInfo]:
+    """
+    Search every term on every provider at once, merged and deduped by url in
+    (page, term, provider) order. Returns as soon as the results cover
+    required_duration, or when search_latency_budget seconds have passed
+    with whatever has arrived by then. While they fall short the next page
+    of every search that still finds videos is fetched, up to
+    max_search_pages.
+    """
+    sources = search_sources(source)
+    queries = [(term, name) for term in search_terms for name in sources]
+    if not queries:
+        return []
+
+    budget = float(config.app.get("search_latency_budget", 60))
+    max_pages = max(1, int(config.app.get("max_search_pages", 3)))
+    workers = max(1, int(config.app.get("max_search_workers", 8)))
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(queries)))
+    futures = {}
+
+    def submit(index: int, page: int):
+        term, name = queries[index]
+        future = pool.submit(
+            search_providers[name][0],
+            search_term=term,
+            minimum_duration=minimum_duration,
+            video_aspect=video_aspect,
+            page=page,
+        )
+        futures[future] = (index, page)
+        return future
+
+    pending = {submit(index, 1) for index in range(len(queries))}
+    results = {}
+
+    def merged() -> List[MaterialInfo]:
+        items, urls = [], set()
+        for index, page in sorted(results, key=lambda k: (k[1], k[0])):
+            for item in results[(index, page)]:
+                if item.url not in urls:
+                    urls.add(item.url)
+                    items.append(item)
+        return items
+
+    started = time.monotonic()
+    try:
+        while pending:
+            remaining = budget - (time.monotonic() - started)
+            if remaining <= 0:
+                raise FuturesTimeoutError()
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, page = futures[future]
+                term, name = queries[index]
+                try:
+                    results[(index, page)] = future.result()
+                except Exception as e:
+                    logger.error(f"search videos failed: {name}, '{term}': {str(e)}")
+                    results[(index, page)] = []
+                logger.info(
+                    f"found {len(results[(index, page)])} videos for '{term}' on {name}, page {page}"
+                )
+
+            covered = sum(min(max_clip_duration, item.duration) for item in merged())
+            if required_duration and covered >= required_duration:
+                logger.info(
+                    f"{covered:.0f}s of videos found after {len(results)} "
+                    f"searches in {time.monotonic() - started:.1f}s, skip the rest"
+                )
+                break
+            if not required_duration:
+                continue
+            # still short, dig deeper into the searches that keep finding videos
+            for future in done:
+                index, page = futures[future]
+                if results[(index, page)] and page < max_pages:
+                    pending.add(submit(index, page + 1))
+    except FuturesTimeoutError:
+        logger.warning(
+            f"search latency budget of {budget}s spent, "
+            f"{len(results)}/{len(futures)} searches answered"
+        )
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    return merged()
 
 
 def download_videos(
@@ -203,26 +517,18 @@ def download_videos(
     audio_duration: float = 0.0,
     max_clip_duration: int = 5,
 ) -> List[str]:
-    valid_video_items = []
-    valid_video_urls = []
-    found_duration = 0.0
-    search_videos = search_videos_pexels
-    if source == "pixabay":
-        search_videos = search_videos_pixabay
-
-    for search_term in search_terms:
-        video_items = search_videos(
-            search_term=search_term,
-            minimum_duration=max_clip_duration,
-            video_aspect=video_aspect,
-        )
-        logger.info(f"found {len(video_items)} videos for '{search_term}'")
-
-        for item in video_items:
-            if item.url not in valid_video_urls:
-                valid_video_items.append(item)
-                valid_video_urls.append(item.url)
-                found_duration += item.duration
+    valid_video_items = search_materials(
+        search_terms=search_terms,
+        source=source,
+        minimum_duration=max_clip_duration,
+        video_aspect=video_aspect,
+        # pagination stops once the audio is covered, search_overfetch asks
+        # for more as room for downloads that fail or turn out invalid
+        required_duration=audio_duration
+        * max(1.0, float(config.app.get("search_overfetch", 1))),
+        max_clip_duration=max_clip_duration,
+    )
+    found_duration = sum(item.duration for item in valid_video_items)
 
     logger.info(
         f"found total videos: {len(valid_video_items)}, required duration: {audio_duration} seconds, found duration: {found_duration} seconds"
@@ -238,25 +544,59 @@ def download_videos(
     if video_contact_mode.value == VideoConcatMode.random.value:
         random.shuffle(valid_video_items)
 
+    # downloads run side by side, the results are still taken in candidate
+    # order so the same candidates always give the same materials
+    workers = max(1, int(config.app.get("max_download_workers", 4)))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    # the pool threads pin the videos they fetch for this task
+    download = processes.bind(_download)
+    cancel_event = threading.Event()
+    futures = {}
+    next_index = 0
     total_duration = 0.0
-    for item in valid_video_items:
-        try:
-            logger.info(f"downloading video: {item.url}")
-            saved_video_path = save_video(
-                video_url=item.url, save_dir=material_directory
+    try:
+        for i, item in enumerate(valid_video_items):
+            # keep enough downloads in flight to cover the duration still missing
+            in_flight = sum(
+                min(max_clip_duration, valid_video_items[j].duration)
+                for j in range(i, next_index)
             )
-            if saved_video_path:
-                logger.info(f"video saved: {saved_video_path}")
-                video_paths.append(saved_video_path)
-                seconds = min(max_clip_duration, item.duration)
-                total_duration += seconds
-                if total_duration > audio_duration:
-                    logger.info(
-                        f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
-                    )
-                    break
-        except Exception as e:
-            logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+            while next_index < len(valid_video_items) and (
+                next_index <= i
+                or (
+                    next_index - i < workers
+                    and total_duration + in_flight <= audio_duration
+                )
+            ):
+                candidate = valid_video_items[next_index]
+                futures[next_index] = pool.submit(
+                    download, candidate.url, material_directory, cancel_event
+                )
+                in_flight += min(max_clip_duration, candidate.duration)
+                next_index += 1
+
+            try:
+                logger.info(f"downloading video: {item.url}")
+                saved_video_path = futures.pop(i).result()
+                if saved_video_path:
+                    logger.info(f"video saved: {saved_video_path}")
+                    video_paths.append(saved_video_path)
+                    seconds = min(max_clip_duration, item.duration)
+                    total_duration += seconds
+                    if total_duration > audio_duration:
+                        logger.info(
+                            f"total duration of downloaded videos: {total_duration} seconds, skip downloading more"
+                        )
+                        break
+            except Exception as e:
+                logger.error(f"failed to download video: {utils.to_json(item)} => {str(e)}")
+    finally:
+        # enough duration is secured, the queued downloads are not started and
+        # the running ones stop at their next chunk (their part files are kept)
+        cancel_event.set()
+        for future in futures.values():
+            future.cancel()
+        pool.shutdown(wait=False, cancel_futures=True)
     logger.success(f"downloaded {len(video_paths)} videos")
     return video_paths
 
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import List
+
+from loguru import logger
+
+from app.services import ffmpeg
+from app.utils import utils
+
+# bumped when the stored info changes shape, older rows are probed again
+version = 1
+# the head and tail of a file are enough to tell materials apart
+sample_size = 1024 * 1024
+
+_lock = threading.Lock()
+_ready = set()
+
+
+def db_path() -> str:
+    return os.path.join(utils.storage_dir(create=True), "metadata.db")
+
+
+def _connect() -> sqlite3.Connection:
+    path = db_path()
+    conn = sqlite3.connect(path, timeout=30)
+    with _lock:
+        if path not in _ready:
+            # several tasks and pool workers read and write it at the same time
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS media ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "hash TEXT, version INTEGER, info TEXT, keyframes TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS media_hash ON media (hash)")
+            _ready.add(path)
+    return conn
+
+
+def content_hash(file_path: str, size: int) -> str:
+    digest = hashlib.md5(str(size).encode("utf-8"))
+    with open(file_path, "rb") as f:
+        digest.update(f.read(sample_size))
+        if size > sample_size * 2:
+            f.seek(-sample_size, os.SEEK_END)
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def _lookup(conn: sqlite3.Connection, file_path: str, stat: os.stat_result):
+    """
+    The indexed row of a file, found by path when it has not been touched
+    since, or by content for a copy of a file probed under another path.
+    """
+    row = conn.execute(
+        "SELECT size, mtime_ns, hash, version, info, keyframes FROM media WHERE path = ?",
+        (file_path,),
+    ).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns and row[3] == version:
+        return row[2], row[4], row[5], True
+
+    file_hash = content_hash(file_path, stat.st_size)
+    row = conn.execute(
+        "SELECT info, keyframes FROM media WHERE hash = ? AND version = ? LIMIT 1",
+        (file_hash, version),
+    ).fetchone()
+    if row:
+        return file_hash, row[0], row[1], False
+    return file_hash, None, None, False
+
+
+def _store(conn, file_path, stat, file_hash, info, keyframes):
+    conn.execute(
+        "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            file_path,
+            stat.st_size,
+            stat.st_mtime_ns,
+            file_hash,
+            version,
+            info,
+            keyframes,
+        ),
+    )
+    conn.commit()
+
+
+def probe(file_path: str) -> dict:
+    """
+    ffmpeg.probe through the index: every file is probed once, later calls
+    from any stage, task or process read the stored duration, size, fps and
+    codec, until the file changes.
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    conn = _connect()
+    try:
+        file_hash, info, keyframes, indexed = _lookup(conn, file_path, stat)
+        if info is None:
+            logger.debug(f"indexing metadata: {file_path}")
+            info = json.dumps(ffmpeg.probe(file_path))
+        if not indexed:
+            _store(conn, file_path, stat, file_hash, info, keyframes)
+        return json.loads(info)
+    finally:
+        conn.close()
+
+
+def keyframes(file_path: str) -> List[float]:
+    """
+    Timestamps of the keyframes of a video, scanned once and kept in the
+    index with the rest of its metadata.
+    """
+    file_path = os.path.abspath(file_path)
+    probe(file_path)
+    stat = os.stat(file_path)
+    conn = _connect()
+    try:
+        file_hash, info, times, _ = _lookup(conn, file_path, stat)
+        if times is None:
+            logger.debug(f"indexing keyframes: {file_path}")
+            times = json.dumps(ffmpeg.keyframes(file_path))
+            _store(conn, file_path, stat, file_hash, info, times)
+        return json.loads(times)
+    finally:
+        conn.close()
+
+
+def forget(file_path: str):
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM media WHERE path = ?", (os.path.abspath(file_path),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def move(src_path: str, dst_path: str):
+    # a renamed file keeps its size and mtime, its row follows it
+    conn = _connect()
+    try:
+        dst_path = os.path.abspath(dst_path)
+        conn.execute("DELETE FROM media WHERE path = ?", (dst_path,))
+        conn.execute(
+            "UPDATE media SET path = ? WHERE path = ?",
+            (dst_path, os.path.abspath(src_path)),
+        )
+        conn.commit()
+    finally:
+        conn.close()
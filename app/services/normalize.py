@@ -0,0 +1,179 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import VideoAspect
+from app.services import ffmpeg, metadata, processes, video_cache
+from app.utils import utils
+
+# Every normalized file shares these settings, so any of them can be spliced
+# with the concat demuxer without re-encoding: same size, SAR, fps, pixel format,
+# timescale and a keyframe on every whole second (no B-frames, so a cut at any
+# packet after a keyframe is clean).
+fps = 30
+gop_seconds = 1
+profile = "x264-bf0-g1s"
+# part of the cached names, copies framed another way are never reused
+framing = "cover"
+
+
+def fit_filter(video_width: int, video_height: int) -> str:
+    # cover the output and cut the overflow in the middle, the same framing
+    # as decoder.open_clip and the image clips, whichever engine renders
+    return (
+        f"scale={video_width}:{video_height}:force_original_aspect_ratio=increase,"
+        f"crop={video_width}:{video_height},"
+        f"setsar=1,setpts=PTS-STARTPTS,fps={fps},format=yuv420p"
+    )
+
+
+def encode_args(threads: int = 2) -> List[str]:
+    gop = fps * gop_seconds
+    return [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "veryfast",
+        "-crf",
+        "20",
+        "-profile:v",
+        "high",
+        "-pix_fmt",
+        "yuv420p",
+        "-r",
+        str(fps),
+        "-bf",
+        "0",
+        "-g",
+        str(gop),
+        "-keyint_min",
+        str(gop),
+        "-sc_threshold",
+        "0",
+        "-force_key_frames",
+        f"expr:gte(t,n_forced*{gop_seconds})",
+        "-video_track_timescale",
+        "90000",
+        "-threads",
+        str(threads),
+    ]
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("normalized_videos", create=True)
+
+
+def source_key(video_path: str) -> str:
+    # downloaded materials are already named after the md5 of their url,
+    # local ones by content, a file edited in place gets a new copy
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    match = re.fullmatch(r"vid-([0-9a-f]{32})", name)
+    if match:
+        return match.group(1)
+    return metadata.content_hash(video_path, os.path.getsize(video_path))
+
+
+def normalized_path(
+    video_path: str, video_aspect: VideoAspect, max_duration: float = 0
+) -> str:
+    aspect = VideoAspect(video_aspect)
+    aspect_tag = aspect.value.replace(":", "x")
+    # a copy of only the first seconds is named after its length
+    length_tag = f"-{max_duration:g}s" if max_duration else ""
+    file_name = (
+        f"norm-{source_key(video_path)}{length_tag}-{aspect_tag}-{framing}-"
+        f"{fps}fps-{profile}.mp4"
+    )
+    return os.path.join(cache_dir(), file_name)
+
+
+def is_normalized(video_path: str) -> bool:
+    # the image clips of images.py are encoded the same way
+    return os.path.basename(video_path).startswith(
+        ("norm-", "img-")
+    ) and video_path.endswith(f"-{profile}.mp4")
+
+
+def is_keyframe_time(t: float) -> bool:
+    return abs(t / gop_seconds - round(t / gop_seconds)) < 1e-3
+
+
+def normalize_video(
+    video_path: str, video_aspect: VideoAspect, max_duration: float = 0
+) -> str:
+    """
+    Transcode a material once to the target size, fps and codec profile and
+    return the cached copy, later tasks reuse it as is. With max_duration
+    only that many seconds from the start are transcoded.
+    """
+    if is_normalized(video_path):
+        return video_path
+    output_path = normalized_path(video_path, video_aspect)
+    # pinned for the task before looking, a sweep can not take it away after
+    video_cache.use(output_path)
+    if max_duration and not (
+        os.path.exists(output_path) and os.path.getsize(output_path) > 0
+    ):
+        # a full copy serves any length, otherwise only the part in use is made
+        output_path = normalized_path(video_path, video_aspect, max_duration)
+        video_cache.use(output_path)
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        logger.info(f"normalized video already exists: {output_path}")
+        return output_path
+
+    video_width, video_height = VideoAspect(video_aspect).to_resolution()
+    threads = config.app.get("ffmpeg_threads_per_process", 2)
+    temp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp.mp4"
+    args = [
+        "-i",
+        video_path,
+        "-vf",
+        fit_filter(video_width, video_height),
+        "-an",
+        *(["-t", f"{max_duration:g}"] if max_duration else []),
+        *encode_args(threads),
+        "-movflags",
+        "+faststart",
+        temp_path,
+    ]
+    try:
+        ffmpeg.run(args, desc="normalize video")
+        # another worker may have finished the same file meanwhile, both are identical
+        os.replace(temp_path, output_path)
+        video_cache.added()
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logger.info(f"normalized video: {video_path} => {output_path}")
+    return output_path
+
+
+def normalize_videos(
+    video_paths: List[str], video_aspect: VideoAspect, max_duration: float = 0
+) -> List[str]:
+    """
+    Normalize materials side by side, at most max_ffmpeg_processes at a time,
+    in the order given. A material that fails is used as it is.
+    """
+    workers = max(1, int(config.app.get("max_ffmpeg_processes", 3)))
+    # the threads only wait on ffmpeg, they run under the caller's task
+    normalize = processes.bind(normalize_video)
+
+    normalized = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(video_paths) or 1)) as pool:
+        futures = {
+            video_path: pool.submit(normalize, video_path, video_aspect, max_duration)
+            for video_path in dict.fromkeys(video_paths)
+        }
+        for video_path in video_paths:
+            try:
+                normalized.append(futures[video_path].result())
+            except Exception as e:
+                logger.warning(f"failed to normalize video {video_path}: {str(e)}")
+                normalized.append(video_path)
+    return normalized
@@ -0,0 +1,237 @@
+import json
+import os
+import random
+from dataclasses import asdict, dataclass
+from typing import List, Optional, Union
+
+from loguru import logger
+
+from app.models.schema import VideoConcatMode, VideoTransitionMode
+from app.services import metadata
+
+xfade_duration = 1.0
+slide_transitions = ["slideleft", "slideright", "slideup", "slidedown"]
+shuffle_transitions = ["fade", "fadeblack"] + slide_transitions
+
+
+@dataclass
+class Segment:
+    path: str
+    start: float
+    end: float
+    transition: str = ""
+    transition_duration: float = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+def transition_value(transition_mode: Optional[VideoTransitionMode]) -> str:
+    if not transition_mode:
+        return VideoTransitionMode.none.value
+    return VideoTransitionMode(transition_mode).value
+
+
+def transition_overlap(transition_mode: Optional[VideoTransitionMode]) -> float:
+    # slides and shuffle are rendered as xfade joins, each one eats its duration
+    if transition_value(transition_mode) in (
+        VideoTransitionMode.slide_in.value,
+        VideoTransitionMode.slide_out.value,
+        VideoTransitionMode.shuffle.value,
+    ):
+        return xfade_duration
+    return 0.0
+
+
+def probe_materials(video_paths: List[str]) -> List[dict]:
+    materials = []
+    for video_path in video_paths:
+        if not os.path.exists(video_path):
+            logger.error(f"Video file does not exist: {video_path}")
+            continue
+        try:
+            info = metadata.probe(video_path)
+        except Exception as e:
+            logger.error(f"Error probing video {video_path}: {str(e)}")
+            continue
+        materials.append({"path": video_path, **info})
+    return materials
+
+
+def plan_timeline(
+    materials: List[dict],
+    audio_duration: float,
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    video_transition_mode: VideoTransitionMode = None,
+    max_clip_duration: float = 5,
+    min_clip_duration: float = 1.5,
+    seed: Union[int, str, None] = None,
+    overlap: Optional[float] = None,
+) -> List[Segment]:
+    """
+    Build the edit decision list for one video from material metadata
+    (path, duration, width, height, fps), no decoder is involved.
+
+    Materials are cut into max_clip_duration chunks (only the first chunk in
+    sequential mode), chunks shorter than min_clip_duration are dropped, and
+    the chunks are repeated until the timeline covers audio_duration exactly.
+    Every join eats `overlap` seconds (xfade), the same seed gives the same plan.
+    """
+    rng = random.Random(seed)
+    concat_mode = VideoConcatMode(video_concat_mode)
+    mode = transition_value(video_transition_mode)
+    if overlap is None:
+        overlap = transition_overlap(video_transition_mode)
+    # a join can never swallow a whole clip
+    overlap = min(overlap, min_clip_duration * 0.75, max_clip_duration * 0.5)
+
+    chunks = []
+    lengths = {}
+    for material in materials:
+        clip_duration = float(material.get("duration") or 0)
+        if clip_duration <= 0 or not material.get("width") or not material.get("height"):
+            logger.warning(f"skip invalid material: {material.get('path')}")
+            continue
+        lengths[material["path"]] = clip_duration
+        start_time = 0.0
+        while start_time < clip_duration:
+            end_time = min(start_time + max_clip_duration, clip_duration)
+            chunks.append(Segment(material["path"], start_time, end_time))
+            start_time = end_time
+            if concat_mode == VideoConcatMode.sequential:
+                break
+
+    if concat_mode == VideoConcatMode.random:
+        rng.shuffle(chunks)
+
+    chunks = [c for c in chunks if c.duration >= min_clip_duration]
+    if not chunks:
+        raise ValueError(
+            f"No clips with sufficient duration (>= {min_clip_duration:.2f}s) were found."
+        )
+
+    segments = []
+    covered = 0.0
+    index = 0
+    while audio_duration - covered > 1e-6:
+        chunk = chunks[index % len(chunks)]
+        index += 1
+
+        join = overlap if segments else 0.0
+        needed = audio_duration - covered + join
+        duration = min(chunk.duration, max_clip_duration, needed)
+        left = needed - duration
+        if 0 < left < min_clip_duration:
+            # do not leave a tail shorter than the minimum for the next clip
+            if duration - (min_clip_duration - left) >= min_clip_duration:
+                duration -= min_clip_duration - left
+
+        transition = ""
+        if segments and overlap:
+            if mode == VideoTransitionMode.shuffle.value:
+                transition = rng.choice(shuffle_transitions)
+            else:
+                transition = rng.choice(slide_transitions)
+        segments.append(
+            Segment(chunk.path, chunk.start, chunk.start + duration, transition, join)
+        )
+        covered += duration - join
+
+    # absorb float drift so the plan ends exactly on the audio
+    segments[-1].end += audio_duration - covered
+    _merge_tail(segments, lengths, min_clip_duration, max_clip_duration)
+    return segments
+
+
+def _merge_tail(
+    segments: List[Segment],
+    lengths: dict,
+    min_clip_duration: float,
+    max_clip_duration: float,
+):
+    """
+    A last clip shorter than the minimum is folded into the ones before it:
+    each runs on past its end, or starts earlier, as far as its material and
+    max_clip_duration allow, until the tail's seconds are taken. When there
+    is not enough room, the tail is lengthened to the minimum from the spare
+    seconds of the clips before it instead.
+    """
+    if len(segments) < 2 or segments[-1].duration >= min_clip_duration:
+        return
+    tail = segments[-1]
+    extra = tail.duration - tail.transition_duration
+    grown = []
+    for segment in reversed(segments[:-1]):
+        room = max(0.0, max_clip_duration - segment.duration)
+        after = min(extra, room, max(0.0, lengths[segment.path] - segment.end))
+        before = min(extra - after, room - after, segment.start)
+        if after or before:
+            grown.append((segment, after, before))
+            extra -= after + before
+        if extra <= 1e-6:
+            break
+    if extra <= 1e-6:
+        for segment, after, before in grown:
+            segment.end += after
+            segment.start -= before
+        segments.pop()
+        return
+
+    # no room to fold it, the tail grows to the minimum instead and the
+    # clips before it give up what they can spare
+    need = min_clip_duration - tail.duration
+    if lengths[tail.path] - tail.duration < need:
+        return
+    shrunk = []
+    for segment in reversed(segments[:-1]):
+        give = min(need, max(0.0, segment.duration - min_clip_duration))
+        if give:
+            shrunk.append((segment, give))
+            need -= give
+        if need <= 1e-6:
+            break
+    if need > 1e-6:
+        # nothing to spare anywhere, a short tail beats a frozen frame
+        return
+    grow = sum(give for _, give in shrunk)
+    for segment, give in shrunk:
+        segment.end -= give
+    after = min(grow, lengths[tail.path] - tail.end)
+    tail.end += after
+    tail.start -= grow - after
+
+
+def drop_overlap(segments: List[Segment]) -> List[Segment]:
+    """
+    The same plan for a renderer that only butts clips together: every join
+    gives up the seconds it would have overlapped at the start of its clip,
+    so the timeline keeps its length and its materials.
+    """
+    return [
+        Segment(s.path, min(s.start + s.transition_duration, s.end), s.end)
+        for s in segments
+    ]
+
+
+def save_plan(plan_file: str, plans: List[List[Segment]], **kwargs) -> str:
+    data = {
+        **kwargs,
+        "variants": [
+            {
+                "index": i + 1,
+                "duration": round(sum(s.duration for s in segments), 3),
+                "segments": [asdict(s) for s in segments],
+            }
+            for i, segments in enumerate(plans)
+        ],
+    }
+    with open(plan_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps(data, ensure_ascii=False, indent=4))
+    return plan_file
+
+
+def load_plan(plan_file: str) -> List[List[Segment]]:
+    with open(plan_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    return [[Segment(**s) for s in v["segments"]] for v in data.get("variants", [])]
@@ -0,0 +1,120 @@
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
+
+from loguru import logger
+
+# task id => ffmpeg processes and moviepy readers started on its behalf
+_registry: Dict[str, List] = {}
+_lock = threading.Lock()
+# every task runs in its own thread, the thread knows which task it works for
+_local = threading.local()
+
+
+def current_task() -> str:
+    task_id = getattr(_local, "task_id", "")
+    return task_id or f"thread-{threading.get_ident()}"
+
+
+@contextmanager
+def task_scope(task_id: str):
+    """
+    Attribute every process started by this thread to task_id, and stop the
+    ones still running when the task is done.
+    """
+    previous = getattr(_local, "task_id", "")
+    _local.task_id = task_id
+    try:
+        yield
+    finally:
+        cleanup(task_id)
+        _local.task_id = previous
+
+
+def bind(func):
+    """
+    Wrap func to run under the calling thread's task, for pool threads
+    working for it. Unlike task_scope nothing is stopped when it returns.
+    """
+    task_id = current_task()
+
+    def run(*args, **kwargs):
+        previous = getattr(_local, "task_id", "")
+        _local.task_id = task_id
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.task_id = previous
+
+    return run
+
+
+def _is_running(item) -> bool:
+    proc = item if isinstance(item, subprocess.Popen) else getattr(item, "proc", None)
+    return proc is not None and proc.poll() is None
+
+
+def register(item):
+    """
+    Track a subprocess.Popen, or a moviepy reader (anything with .proc and
+    close(), it may restart its process when seeking) for the current task.
+    """
+    if item is None:
+        return item
+    task_id = current_task()
+    with _lock:
+        # forget the ones that already finished so the list stays short
+        items = [i for i in _registry.get(task_id, []) if _is_running(i)]
+        items.append(item)
+        _registry[task_id] = items
+    return item
+
+
+def unregister(item):
+    task_id = current_task()
+    with _lock:
+        items = _registry.get(task_id, [])
+        if item in items:
+            items.remove(item)
+
+
+def track_clip(clip):
+    # file clips keep their ffmpeg processes on .reader, and so does their audio
+    for owner in (clip, getattr(clip, "audio", None)):
+        reader = getattr(owner, "reader", None)
+        if reader is not None and hasattr(reader, "proc"):
+            register(reader)
+    return clip
+
+
+def _stop(item):
+    if not isinstance(item, subprocess.Popen):
+        # moviepy readers terminate their own process and close the pipes
+        item.close()
+        return
+    item.terminate()
+    try:
+        item.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        item.kill()
+        item.wait()
+
+
+def cleanup(task_id: str = ""):
+    """
+    Stop the processes of one task (the current one by default), processes
+    of other tasks running on the same machine are left alone.
+    """
+    task_id = task_id or current_task()
+    with _lock:
+        items = _registry.pop(task_id, [])
+    running = [item for item in items if _is_running(item)]
+    for item in running:
+        try:
+            _stop(item)
+        except Exception as e:
+            logger.warning(f"failed to stop process of task {task_id}: {str(e)}")
+    if running:
+        logger.info(f"stopped {len(running)} ffmpeg processes of task {task_id}")
+    return len(running)
@@ -0,0 +1,451 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Union
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import (
+    VideoAspect,
+    VideoConcatMode,
+    VideoParams,
+    VideoTransitionMode,
+)
+from app.services import (
+    ass,
+    ffmpeg,
+    metadata,
+    normalize,
+    planner,
+    processes,
+    video,
+    watchdog,
+)
+from app.services.planner import Segment
+
+
+def _x264_args(threads: int) -> List[str]:
+    # the delivery profile of the moviepy engine, every part of a video uses it
+    # so the parts can be joined with the concat demuxer
+    return [
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-crf",
+        "28",
+        "-maxrate",
+        "2000k",
+        "-bufsize",
+        "4000k",
+        "-pix_fmt",
+        "yuv420p",
+        "-r",
+        str(normalize.fps),
+        "-video_track_timescale",
+        "90000",
+        "-threads",
+        str(threads),
+    ]
+
+
+def _video_filters(
+    segments: List[Segment],
+    video_width: int,
+    video_height: int,
+    params: VideoParams,
+) -> List[str]:
+    # scale/pad, fps and the per-segment fades, then concat or xfade into [vcat]
+    mode = planner.transition_value(params.video_transition_mode)
+    fade = min([planner.xfade_duration] + [s.duration / 2 for s in segments])
+
+    filters = []
+    for i, segment in enumerate(segments):
+        chain = f"[{i}:v]{normalize.fit_filter(video_width, video_height)}"
+        if mode == VideoTransitionMode.fade_in.value:
+            chain += f",fade=t=in:st=0:d={fade:.3f}"
+        elif mode == VideoTransitionMode.fade_out.value:
+            chain += f",fade=t=out:st={segment.duration - fade:.3f}:d={fade:.3f}"
+        filters.append(f"{chain}[v{i}]")
+
+    if has_xfade(segments):
+        last = "v0"
+        offset = segments[0].duration
+        for i, segment in enumerate(segments[1:], start=1):
+            overlap = segment.transition_duration or planner.xfade_duration
+            offset -= overlap
+            filters.append(
+                f"[{last}][v{i}]xfade=transition={segment.transition or 'fade'}:"
+                f"duration={overlap:.3f}:offset={offset:.3f}[x{i}]"
+            )
+            offset += segment.duration
+            last = f"x{i}"
+        filters.append(f"[{last}]null[vcat]")
+    else:
+        inputs = "".join(f"[v{i}]" for i in range(len(segments)))
+        filters.append(f"{inputs}concat=n={len(segments)}:v=1:a=0[vcat]")
+    return filters
+
+
+def _audio_filters(
+    audio_index: int, audio_duration: float, params: VideoParams, bgm_file: str = ""
+) -> List[str]:
+    # voice and looped bgm mixed into [aout]
+    filters = [f"[{audio_index}:a]volume={params.voice_volume}[voice]"]
+    if bgm_file:
+        fade_start = max(audio_duration - 3, 0)
+        filters.append(
+            f"[{audio_index + 1}:a]volume={params.bgm_volume},atrim=0:{audio_duration:.3f},"
+            f"afade=t=out:st={fade_start:.3f}:d=3[bgm]"
+        )
+        filters.append(
+            "[voice][bgm]amix=inputs=2:duration=first:dropout_transition=0:normalize=0[aout]"
+        )
+    else:
+        filters.append("[voice]anull[aout]")
+    return filters
+
+
+def _audio_inputs(audio_file: str, bgm_file: str = "") -> List[str]:
+    args = ["-i", audio_file]
+    if bgm_file:
+        args += ["-stream_loop", "-1", "-i", bgm_file]
+    return args
+
+
+def _segment_inputs(segments: List[Segment]) -> List[str]:
+    args = []
+    for segment in segments:
+        args += ["-ss", f"{segment.start:.3f}", "-t", f"{segment.duration:.3f}"]
+        args += ["-i", segment.path]
+    return args
+
+
+def has_xfade(segments: List[Segment]) -> bool:
+    return any(s.transition for s in segments[1:])
+
+
+def build_part_command(
+    segments: List[Segment],
+    offset: float,
+    output_file: str,
+    video_width: int,
+    video_height: int,
+    params: VideoParams,
+    subtitle_path: str = "",
+    combined_video_path: str = "",
+    threads: int = 2,
+) -> List[str]:
+    """
+    Build the video-only ffmpeg invocation for one part of the timeline that
+    starts at offset seconds, the parts are joined with the concat demuxer.
+    """
+    args = _segment_inputs(segments)
+    filters = _video_filters(segments, video_width, video_height, params)
+
+    video_label = "vcat"
+    if combined_video_path:
+        filters.append("[vcat]split=2[vcomb][vmain]")
+        video_label = "vmain"
+
+    if subtitle_path and os.path.exists(subtitle_path):
+        subtitle_filter = ass.burn_filter(subtitle_path, offset)
+        filters.append(f"[{video_label}]{subtitle_filter}[vout]")
+    else:
+        filters.append(f"[{video_label}]null[vout]")
+
+    args += ["-filter_complex", ";".join(filters)]
+    if combined_video_path:
+        args += ["-map", "[vcomb]", "-an", *_x264_args(threads), combined_video_path]
+    args += ["-map", "[vout]", "-an", *_x264_args(threads), output_file]
+    return args
+
+
+def can_concat_copy(segments: List[Segment], params: VideoParams) -> bool:
+    mode = planner.transition_value(params.video_transition_mode)
+    if mode != VideoTransitionMode.none.value:
+        return False
+    for segment in segments:
+        if not normalize.is_normalized(segment.path):
+            return False
+        if not normalize.is_keyframe_time(segment.start):
+            return False
+    return True
+
+
+def _write_concat_list(segments: List[Segment], list_file: str) -> str:
+    lines = ["ffconcat version 1.0"]
+    for segment in segments:
+        segment_path = os.path.abspath(segment.path).replace("'", "'\\''")
+        lines.append(f"file '{segment_path}'")
+        lines.append(f"inpoint {segment.start:.3f}")
+        lines.append(f"outpoint {segment.end:.3f}")
+    with open(list_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    return list_file
+
+
+def concat_copy(segments: List[Segment], output_file: str) -> str:
+    """
+    Splice normalized materials with the concat demuxer, no decoding or encoding.
+    """
+    list_file = _write_concat_list(segments, f"{output_file}.txt")
+    try:
+        args = ["-f", "concat", "-safe", "0", "-i", list_file]
+        args += ["-map", "0:v", "-c", "copy", "-an", "-movflags", "+faststart", output_file]
+        ffmpeg.run(args, desc="concat videos")
+    finally:
+        os.remove(list_file)
+    return output_file
+
+
+def split_timeline(segments: List[Segment], parts: int) -> List[List[Segment]]:
+    # contiguous groups of roughly equal duration
+    total = sum(s.duration for s in segments)
+    target = total / max(parts, 1)
+    groups = [[]]
+    elapsed = 0.0
+    for segment in segments:
+        if groups[-1] and elapsed >= target * len(groups) and len(groups) < parts:
+            groups.append([])
+        groups[-1].append(segment)
+        elapsed += segment.duration
+    return groups
+
+
+def mix_audio(
+    audio_file: str,
+    audio_duration: float,
+    params: VideoParams,
+    bgm_file: str,
+    output_file: str,
+) -> str:
+    """
+    Encode the voice and bgm mix once, every variant muxes it as is.
+    """
+    args = _audio_inputs(audio_file, bgm_file)
+    args += ["-filter_complex", ";".join(_audio_filters(0, audio_duration, params, bgm_file))]
+    args += ["-map", "[aout]", "-c:a", "aac", "-b:a", "192k"]
+    args += ["-t", f"{audio_duration:.3f}", output_file]
+    ffmpeg.run(args, desc="mix audio")
+    return output_file
+
+
+def _plan_parts(
+    segments: List[Segment],
+    output_file: str,
+    combined_video_path: str,
+    parts: int,
+    params: VideoParams,
+) -> dict:
+    # what has to be encoded for one variant and how it is put together after,
+    # only the combined video may be spliced from the materials, the final one
+    # is always encoded so it ships the delivery profile (_x264_args)
+    copy_combined = bool(combined_video_path) and can_concat_copy(segments, params)
+    variant = {
+        "segments": segments,
+        "output_file": output_file,
+        "combined_video_path": combined_video_path,
+        "copy_combined": copy_combined,
+        "groups": [],
+        "part_files": [],
+        "combined_files": [],
+    }
+    # xfade joins need both neighbours in one graph, those timelines are one part
+    if has_xfade(segments):
+        parts = 1
+    variant["groups"] = split_timeline(segments, min(parts, len(segments)))
+    for i in range(len(variant["groups"])):
+        variant["part_files"].append(f"{output_file}.part{i}.mp4")
+        if combined_video_path and not copy_combined:
+            variant["combined_files"].append(f"{combined_video_path}.part{i}.mp4")
+    return variant
+
+
+def _join_parts(variant: dict, audio_file: str, audio_duration: float, ass_path: str = ""):
+    def as_segments(files):
+        return [Segment(f, 0, ffmpeg.probe(f)["duration"]) for f in files]
+
+    segments = variant["segments"]
+    output_file = variant["output_file"]
+    combined_video_path = variant["combined_video_path"]
+    if variant["copy_combined"]:
+        concat_copy(segments, combined_video_path)
+    elif combined_video_path:
+        concat_copy(as_segments(variant["combined_files"]), combined_video_path)
+
+    list_file = _write_concat_list(as_segments(variant["part_files"]), f"{output_file}.txt")
+    try:
+        args = ["-f", "concat", "-safe", "0", "-i", list_file, "-i", audio_file]
+        if ass_path:
+            args += ["-i", ass_path]
+        args += ["-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "copy"]
+        if ass_path:
+            # soft subtitles, mp4 only carries mov_text
+            args += ["-map", "2:s", "-c:s", "mov_text"]
+        args += ["-movflags", "+faststart", "-t", f"{audio_duration:.3f}", output_file]
+        ffmpeg.run(args, desc="join parts")
+    finally:
+        os.remove(list_file)
+
+
+def render_variants(
+    plans: List[List[Segment]],
+    audio_file: str,
+    subtitle_path: str,
+    output_files: List[str],
+    params: VideoParams,
+    combined_video_paths: List[str] = None,
+) -> List[str]:
+    """
+    Render every planned variant of a task in one go. The audio mix and the
+    subtitles are prepared once, the parts of all variants share one pool of
+    max_ffmpeg_processes ffmpeg processes, and each variant is joined from its
+    parts with the concat demuxer (no second encode).
+    """
+    aspect = VideoAspect(params.video_aspect)
+    video_width, video_height = aspect.to_resolution()
+    combined_video_paths = combined_video_paths or [""] * len(plans)
+
+    audio_duration = metadata.probe(audio_file)["duration"]
+    logger.info(f"max duration of audio: {audio_duration} seconds")
+
+    ass_path = ""
+    if params.subtitle_enabled and subtitle_path and os.path.exists(subtitle_path):
+        ass_path = ass.create(subtitle_path, params, video_width, video_height)
+    # soft subtitles are muxed as a track when the parts are joined
+    burn_path = ass_path if params.subtitle_mode != ass.soft else ""
+    soft_path = ass_path if params.subtitle_mode == ass.soft else ""
+    if burn_path and not ffmpeg.has_filter("subtitles"):
+        raise RuntimeError("ffmpeg is built without libass, cannot burn subtitles")
+
+    bgm_file = video.get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+    threads = config.app.get("ffmpeg_threads_per_process", params.n_threads or 2)
+    workers = max(1, int(config.app.get("max_ffmpeg_processes", 3)))
+    # a single variant is cut into parts, several variants run side by side
+    parts = max(1, workers // len(plans))
+
+    variants = []
+    part_args = []
+    for segments, output_file, combined_video_path in zip(
+        plans, output_files, combined_video_paths
+    ):
+        logger.info(f"planned {len(segments)} segments for {output_file}")
+        variant = _plan_parts(segments, output_file, combined_video_path, parts, params)
+        offset = 0.0
+        for i, group in enumerate(variant["groups"]):
+            part_args.append(
+                build_part_command(
+                    segments=group,
+                    offset=offset,
+                    output_file=variant["part_files"][i],
+                    video_width=video_width,
+                    video_height=video_height,
+                    params=params,
+                    subtitle_path=burn_path,
+                    combined_video_path=(
+                        variant["combined_files"][i] if variant["combined_files"] else ""
+                    ),
+                    threads=threads,
+                )
+            )
+            offset += sum(s.duration for s in group)
+        variants.append(variant)
+
+    mixed_audio = f"{output_files[0]}.audio.m4a"
+    temp_files = [mixed_audio]
+    for variant in variants:
+        temp_files += variant["part_files"] + variant["combined_files"]
+    try:
+        mix_audio(audio_file, audio_duration, params, bgm_file, mixed_audio)
+
+        logger.info(
+            f"rendering {len(plans)} videos, {len(part_args)} parts in "
+            f"{min(workers, len(part_args) or 1)} processes"
+        )
+        if len(part_args) > 1 and workers > 1:
+            # ffmpeg does the work in its own processes, threads only wait on
+            # them and register them with the task, which can stop them
+            run = processes.bind(ffmpeg.run)
+            pool = ThreadPoolExecutor(max_workers=min(workers, len(part_args)))
+            try:
+                futures, pending = [], set()
+                for args in part_args:
+                    # under memory pressure fewer parts run at once, and then
+                    # none starts until one of the running ones is done
+                    while pending and (
+                        len(pending) >= watchdog.parallelism(workers) or watchdog.paused()
+                    ):
+                        _, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+                    future = pool.submit(run, args, "render part")
+                    futures.append(future)
+                    pending.add(future)
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # one part failed, the others are no use anymore
+                pool.shutdown(wait=False, cancel_futures=True)
+                processes.cleanup()
+                raise
+            finally:
+                pool.shutdown(wait=True)
+        else:
+            for args in part_args:
+                ffmpeg.run(args, desc="render part")
+
+        for variant in variants:
+            _join_parts(variant, mixed_audio, audio_duration, soft_path)
+            logger.success(f"video rendered: {variant['output_file']}")
+    finally:
+        for f in temp_files:
+            if os.path.exists(f):
+                os.remove(f)
+    return output_files
+
+
+def render_video(
+    video_paths: List[str],
+    audio_file: str,
+    subtitle_path: str,
+    output_file: str,
+    params: VideoParams,
+    combined_video_path: str = "",
+    video_concat_mode: VideoConcatMode = VideoConcatMode.random,
+    max_clip_duration: int = 5,
+    min_clip_duration: float = 1.5,
+    segments: List[Segment] = None,
+    seed: Union[int, str, None] = None,
+) -> str:
+    """
+    Render the final video with ffmpeg instead of compositing frames in moviepy,
+    also writing the combined video when a path is given. Without a planned
+    timeline (segments) one is planned from video_paths.
+    """
+    if not segments:
+        aspect = VideoAspect(params.video_aspect)
+        if config.app.get("normalize_materials", True):
+            video_paths = normalize.normalize_videos(
+                video_paths,
+                aspect,
+                max_duration=max_clip_duration
+                if VideoConcatMode(video_concat_mode) == VideoConcatMode.sequential
+                else 0,
+            )
+        segments = planner.plan_timeline(
+            materials=planner.probe_materials(video_paths),
+            audio_duration=metadata.probe(audio_file)["duration"],
+            video_concat_mode=video_concat_mode,
+            video_transition_mode=params.video_transition_mode,
+            max_clip_duration=max_clip_duration,
+            min_clip_duration=min_clip_duration,
+            seed=seed,
+        )
+    render_variants(
+        plans=[segments],
+        audio_file=audio_file,
+        subtitle_path=subtitle_path,
+        output_files=[output_file],
+        params=params,
+        combined_video_paths=[combined_video_path],
+    )
+    return output_file
@@ -0,0 +1,60 @@
+from typing import List, Optional
+
+from app.config import config
+
+# bits per pixel of a typical stock h264 file, to guess the size of a
+# rendition the provider reports nothing about
+bits_per_pixel = 0.1
+default_fps = 30
+
+
+def max_upscale() -> float:
+    # how much a rendition may be scaled up to cover the output, 1 = never
+    return max(1.0, float(config.app.get("rendition_max_upscale", 1.0)))
+
+
+def cover_scale(width: int, height: int, target_width: int, target_height: int) -> float:
+    """
+    The factor a width x height video is scaled by to cover the target before
+    the overflow is cropped, above 1 it is blown up and loses detail.
+    """
+    return max(target_width / width, target_height / height)
+
+
+def estimated_size(rendition: dict, duration: float) -> float:
+    """
+    Bytes of a rendition: the reported size, else its bitrate over the
+    duration, else a guess from the pixels and frame rate.
+    """
+    if rendition.get("size"):
+        return float(rendition["size"])
+    if rendition.get("bitrate"):
+        return float(rendition["bitrate"]) * max(1.0, duration) / 8
+    fps = rendition.get("fps") or default_fps
+    pixels = rendition["width"] * rendition["height"]
+    return pixels * fps * bits_per_pixel * max(1.0, duration) / 8
+
+
+def choose(
+    renditions: List[dict],
+    target_width: int,
+    target_height: int,
+    duration: float = 0,
+) -> Optional[dict]:
+    """
+    The cheapest rendition that still covers target_width x target_height
+    after the cover crop, None when every one is too small. renditions are
+    dicts with url, width, height and optionally size (bytes), bitrate
+    (bits per second) and fps.
+    """
+    best, best_cost = None, None
+    for rendition in renditions:
+        width, height = rendition.get("width") or 0, rendition.get("height") or 0
+        if not rendition.get("url") or width <= 0 or height <= 0:
+            continue
+        if cover_scale(width, height, target_width, target_height) > max_upscale():
+            continue
+        cost = (estimated_size(rendition, duration), width * height)
+        if best_cost is None or cost < best_cost:
+            best, best_cost = rendition, cost
+    return best
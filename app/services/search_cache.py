@@ -0,0 +1,114 @@
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from app.config import config
+from app.models.schema import MaterialInfo
+from app.utils import utils
+
+# hits and misses of this process, per provider
+_counters = {}
+# bumped when the results of a search are picked differently, older entries
+# are searched again
+version = 2
+_lock = threading.Lock()
+
+
+def cache_dir() -> str:
+    return utils.storage_dir("search_cache", create=True)
+
+
+def ttl() -> float:
+    # seconds a search result is reused, 0 disables the cache
+    return float(config.app.get("search_cache_ttl", 86400))
+
+
+def key(
+    provider: str,
+    search_term: str,
+    orientation: str,
+    minimum_duration: int,
+    per_page: int,
+    page: int = 1,
+) -> str:
+    return utils.md5(
+        json.dumps(
+            [
+                version,
+                provider,
+                search_term.strip().lower(),
+                orientation,
+                minimum_duration,
+                per_page,
+                page,
+            ]
+        )
+    )
+
+
+def _count(provider: str, outcome: str):
+    with _lock:
+        counters = _counters.setdefault(provider, {"hits": 0, "misses": 0})
+        counters[outcome] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        return {provider: dict(counters) for provider, counters in _counters.items()}
+
+
+def get(provider: str, cache_key: str) -> Optional[List[MaterialInfo]]:
+    """
+    The cached result of a search, None when there is none or it expired.
+    """
+    if ttl() <= 0:
+        return None
+    cache_file = os.path.join(cache_dir(), f"{provider}-{cache_key}.json")
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        _count(provider, "misses")
+        return None
+    if time.time() - data.get("time", 0) > ttl():
+        _count(provider, "misses")
+        return None
+
+    _count(provider, "hits")
+    items = []
+    for entry in data.get("items", []):
+        item = MaterialInfo()
+        item.provider = entry.get("provider", provider)
+        item.url = entry.get("url", "")
+        item.duration = entry.get("duration", 0)
+        items.append(item)
+    logger.info(f"search cache hit: {provider}, {len(items)} videos, {stats()[provider]}")
+    return items
+
+
+def put(provider: str, cache_key: str, items: List[MaterialInfo]):
+    if ttl() <= 0:
+        return
+    cache_file = os.path.join(cache_dir(), f"{provider}-{cache_key}.json")
+    data = {
+        "time": time.time(),
+        "items": [
+            {"provider": item.provider, "url": item.url, "duration": item.duration}
+            for item in items
+        ],
+    }
+    # written aside and renamed, readers in other workers never see half a file
+    temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_file, cache_file)
+    except OSError as e:
+        logger.warning(f"failed to write search cache {cache_file}: {str(e)}")
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
@@ -11,6 +11,10 @@ class BaseState(ABC):
     def update_task(self, task_id: str, state: int, progress: int = 0, **kwargs):
         pass
 
+    @abstractmethod
+    def update_fields(self, task_id: str, **kwargs):
+        pass
+
     @abstractmethod
     def get_task(self, task_id: str):
         pass
@@ -43,13 +47,23 @@ class MemoryState(BaseState):
         if progress > 100:
             progress = 100
 
+        # fields not given are kept, the same as the hash fields in RedisState
         self._tasks[task_id] = {
+            **self._tasks.get(task_id, {}),
             "task_id": task_id,
             "state": state,
             "progress": progress,
             **kwargs,
         }
 
+    def update_fields(self, task_id: str, **kwargs):
+        # only the given fields, state and progress stay as they are
+        self._tasks[task_id] = {
+            **self._tasks.get(task_id, {}),
+            "task_id": task_id,
+            **kwargs,
+        }
+
     def get_task(self, task_id: str):
         return self._tasks.get(task_id, None)
 
@@ -108,6 +122,12 @@ class RedisState(BaseState):
         for field, value in fields.items():
             self._redis.hset(task_id, field, str(value))
 
+    def update_fields(self, task_id: str, **kwargs):
+        # only the given fields, state and progress stay as they are
+        fields = {"task_id": task_id, **kwargs}
+        for field, value in fields.items():
+            self._redis.hset(task_id, field, str(value))
+
     def get_task(self, task_id: str):
         task_data = self._redis.hgetall(task_id)
         if not task_data:
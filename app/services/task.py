@@ -9,7 +9,21 @@ from loguru import logger
 from app.config import config
 from app.models import const
 from app.models.schema import VideoConcatMode, VideoParams
-from app.services import llm, material, subtitle, video, voice
+from app.services import (
+    decoder,
+    llm,
+    material,
+    metadata,
+    normalize,
+    planner,
+    processes,
+    render,
+    subtitle,
+    video,
+    video_cache,
+    voice,
+    watchdog,
+)
 from app.services import state as sm
 from app.utils import utils
 
@@ -128,7 +142,9 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
     if params.video_source == "local":
         logger.info("\n\n## preprocess local materials")
         materials = video.preprocess_video(
-            materials=params.video_materials, clip_duration=params.video_clip_duration
+            materials=params.video_materials,
+            clip_duration=params.video_clip_duration,
+            video_aspect=params.video_aspect,
         )
         if not materials:
             sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -160,76 +176,154 @@ def get_video_materials(task_id, params, video_terms, audio_duration):
 def generate_final_videos(
     task_id, params, downloaded_videos, audio_file, subtitle_path
 ):
-    final_video_paths = []
-    combined_video_paths = []
     video_concat_mode = (
         params.video_concat_mode if params.video_count == 1 else VideoConcatMode.random
     )
     video_transition_mode = params.video_transition_mode
-
-    _progress = 50
-    for i in range(params.video_count):
-        index = i + 1
-        combined_video_path = path.join(
-            utils.task_dir(task_id), f"combined-{index}.mp4"
+    render_engine = config.app.get("render_engine", "ffmpeg").strip().lower()
+
+    video_paths = downloaded_videos
+    if render_engine == "ffmpeg" and config.app.get("normalize_materials", True):
+        logger.info("\n\n## normalizing materials")
+        video_paths = normalize.normalize_videos(
+            downloaded_videos,
+            params.video_aspect,
+            # sequential plans only use the first clip of every material
+            max_duration=params.video_clip_duration
+            if VideoConcatMode(video_concat_mode) == VideoConcatMode.sequential
+            else 0,
         )
-        logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
-        try:
-            video.combine_videos(
-                combined_video_path=combined_video_path,
-                video_paths=downloaded_videos,
-                audio_file=audio_file,
-                video_aspect=params.video_aspect,
+
+    logger.info("\n\n## planning timelines")
+    try:
+        audio_duration = metadata.probe(audio_file)["duration"]
+        materials = planner.probe_materials(video_paths)
+        plans = [
+            planner.plan_timeline(
+                materials=materials,
+                audio_duration=audio_duration,
                 video_concat_mode=video_concat_mode,
                 video_transition_mode=video_transition_mode,
                 max_clip_duration=params.video_clip_duration,
-                min_clip_duration=1.5,  # Thêm tham số thời lượng tối thiểu 1.5 giây
-                threads=params.n_threads,
+                min_clip_duration=1.5,
+                seed=f"{task_id}-{i + 1}",
+                # moviepy applies its transitions per clip, nothing overlaps
+                overlap=None if render_engine == "ffmpeg" else 0,
             )
-        except Exception as e:
-            logger.error(f"Error combining videos: {str(e)}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            # Create an error file to indicate the error
-            with open(f"{combined_video_path}.error.txt", "w") as f:
-                f.write(f"Error: {str(e)}\n{traceback.format_exc()}")
-            # Update task state to failed
-            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-            return None, None
-
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
-
-        final_video_path = path.join(utils.task_dir(task_id), f"final-{index}.mp4")
-
-        logger.info(f"\n\n## generating video: {index} => {final_video_path}")
+            for i in range(params.video_count)
+        ]
+        plan_file = path.join(utils.task_dir(task_id), "plan.json")
+        planner.save_plan(
+            plan_file, plans, audio_duration=audio_duration, render_engine=render_engine
+        )
+    except Exception as e:
+        logger.error(f"Error planning videos: {str(e)}")
+        sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+        return None, None
+
+    final_video_paths = [
+        path.join(utils.task_dir(task_id), f"final-{i + 1}.mp4")
+        for i in range(params.video_count)
+    ]
+    combined_video_paths = [
+        path.join(utils.task_dir(task_id), f"combined-{i + 1}.mp4")
+        for i in range(params.video_count)
+    ]
+    if render_engine == "ffmpeg":
+        logger.info(f"\n\n## rendering {params.video_count} videos")
         try:
-            video.generate_video(
-                video_path=combined_video_path,
-                audio_path=audio_file,
+            # audio, subtitles and materials are prepared once for all variants
+            render.render_variants(
+                plans=plans,
+                audio_file=audio_file,
                 subtitle_path=subtitle_path,
-                output_file=final_video_path,
+                output_files=final_video_paths,
                 params=params,
+                combined_video_paths=combined_video_paths,
             )
+            sm.state.update_task(task_id, progress=100)
+            return final_video_paths, combined_video_paths
         except Exception as e:
-            logger.error(f"Error generating final video: {str(e)}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            # Create an error file to indicate the error
-            with open(f"{final_video_path}.error.txt", "w") as f:
-                f.write(f"Error: {str(e)}\n{traceback.format_exc()}")
-            # Update task state to failed
-            sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
-            return None, None
-
-        _progress += 50 / params.video_count / 2
-        sm.state.update_task(task_id, progress=_progress)
-
-        final_video_paths.append(final_video_path)
-        combined_video_paths.append(combined_video_path)
+            logger.warning(f"ffmpeg render failed, falling back to moviepy: {str(e)}")
+            # the same timelines without the xfade overlaps, saved again so the
+            # plan still describes the videos that get rendered
+            plans = [planner.drop_overlap(segments) for segments in plans]
+            planner.save_plan(
+                plan_file, plans, audio_duration=audio_duration, render_engine="moviepy"
+            )
 
+    _progress = 50
+    try:
+        for i in range(params.video_count):
+            index = i + 1
+            seed = f"{task_id}-{index}"
+            combined_video_path = combined_video_paths[i]
+            final_video_path = final_video_paths[i]
+
+            logger.info(f"\n\n## combining video: {index} => {combined_video_path}")
+            try:
+                video.combine_videos(
+                    combined_video_path=combined_video_path,
+                    video_paths=video_paths,
+                    audio_file=audio_file,
+                    video_aspect=params.video_aspect,
+                    video_concat_mode=video_concat_mode,
+                    video_transition_mode=video_transition_mode,
+                    max_clip_duration=params.video_clip_duration,
+                    min_clip_duration=1.5,  # Thêm tham số thời lượng tối thiểu 1.5 giây
+                    threads=params.n_threads,
+                    seed=seed,
+                    segments=plans[i],
+                )
+            except Exception as e:
+                logger.error(f"Error combining videos: {str(e)}")
+                logger.error(f"Traceback: {traceback.format_exc()}")
+                # Create an error file to indicate the error
+                with open(f"{combined_video_path}.error.txt", "w") as f:
+                    f.write(f"Error: {str(e)}\n{traceback.format_exc()}")
+                # Update task state to failed
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+                return None, None
+
+            _progress += 50 / params.video_count / 2
+            sm.state.update_task(task_id, progress=_progress)
+
+            logger.info(f"\n\n## generating video: {index} => {final_video_path}")
+            try:
+                video.generate_video(
+                    video_path=combined_video_path,
+                    audio_path=audio_file,
+                    subtitle_path=subtitle_path,
+                    output_file=final_video_path,
+                    params=params,
+                )
+            except Exception as e:
+                logger.error(f"Error generating final video: {str(e)}")
+                logger.error(f"Traceback: {traceback.format_exc()}")
+                # Create an error file to indicate the error
+                with open(f"{final_video_path}.error.txt", "w") as f:
+                    f.write(f"Error: {str(e)}\n{traceback.format_exc()}")
+                # Update task state to failed
+                sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
+                return None, None
+
+            _progress += 50 / params.video_count / 2
+            sm.state.update_task(task_id, progress=_progress)
+    finally:
+        # every variant is done with the materials, or one of them failed,
+        # either way the decoders this task pooled are stopped
+        decoder.close_task(task_id)
     return final_video_paths, combined_video_paths
 
 
 def start(task_id, params: VideoParams, stop_at: str = "video"):
+    # ffmpeg processes started by this task are tracked, and stopped when it
+    # ends, the cached videos it uses are kept from eviction until then
+    with processes.task_scope(task_id), video_cache.pinning(task_id):
+        return _start(task_id, params, stop_at)
+
+
+def _start(task_id, params: VideoParams, stop_at: str = "video"):
     logger.info(f"start task: {task_id}, stop_at: {stop_at}")
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=5)
 
@@ -323,9 +417,10 @@ def start(task_id, params: VideoParams, stop_at: str = "video"):
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
 
     # 6. Generate final videos
-    final_video_paths, combined_video_paths = generate_final_videos(
-        task_id, params, downloaded_videos, audio_file, subtitle_path
-    )
+    with watchdog.watch(task_id):
+        final_video_paths, combined_video_paths = generate_final_videos(
+            task_id, params, downloaded_videos, audio_file, subtitle_path
+        )
 
     if not final_video_paths:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -0,0 +1,113 @@
+import bisect
+import functools
+import math
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+
+@functools.lru_cache(maxsize=64)
+def get_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    # loading a font parses the whole file, keep one per (path, size)
+    return ImageFont.truetype(font_path, font_size)
+
+
+def _rgba(color, default=None):
+    if not isinstance(color, str) or not color:
+        return default
+    try:
+        return ImageColor.getrgb(color)
+    except ValueError:
+        return default
+
+
+def render_text(
+    text: str,
+    font_path: str,
+    font_size: int,
+    color: str = "#FFFFFF",
+    bg_color: str = "",
+    stroke_color: str = "#000000",
+    stroke_width: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rasterize (wrapped) text once and return it premultiplied, as float32
+    RGB (h, w, 3) and alpha (h, w, 1) in 0..1, ready to blend into frames.
+    """
+    font = get_font(font_path, font_size)
+    draw = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = draw.multiline_textbbox(
+        (0, 0), text, font=font, stroke_width=stroke_width, align="center"
+    )
+    left, top = math.floor(left), math.floor(top)
+    width = max(1, math.ceil(right) - left)
+    height = max(1, math.ceil(bottom) - top)
+
+    background = _rgba(bg_color)
+    image = Image.new("RGBA", (width, height), background or (0, 0, 0, 0))
+    ImageDraw.Draw(image).multiline_text(
+        (-left, -top),
+        text,
+        font=font,
+        fill=_rgba(color, (255, 255, 255)),
+        stroke_width=stroke_width,
+        stroke_fill=_rgba(stroke_color, (0, 0, 0)),
+        align="center",
+    )
+
+    pixels = np.asarray(image, dtype=np.float32) / 255
+    alpha = pixels[:, :, 3:4]
+    rgb = pixels[:, :, :3] * alpha * 255
+    # cached callers share the arrays between frames, never write to them
+    rgb.flags.writeable = False
+    alpha.flags.writeable = False
+    return rgb, alpha
+
+
+def blend(frame: np.ndarray, overlay: Tuple[np.ndarray, np.ndarray], x: int, y: int):
+    """
+    Alpha-composite a premultiplied overlay into frame in place, only the
+    overlay's bounding box (clipped to the frame) is touched.
+    """
+    rgb, alpha = overlay
+    frame_h, frame_w = frame.shape[:2]
+    h, w = alpha.shape[:2]
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(frame_w, x + w), min(frame_h, y + h)
+    if x0 >= x1 or y0 >= y1:
+        return frame
+
+    region = frame[y0:y1, x0:x1, :3]
+    a = alpha[y0 - y : y1 - y, x0 - x : x1 - x]
+    src = rgb[y0 - y : y1 - y, x0 - x : x1 - x]
+    region[:] = (src + region * (1 - a) + 0.5).astype(np.uint8)
+    return frame
+
+
+class OverlayTrack:
+    """
+    Timed overlays (start, end, overlay, x, y) looked up per frame with a
+    binary search, usable as a moviepy image transform.
+    """
+
+    def __init__(self, items: List[Tuple[float, float, tuple, int, int]]):
+        self.items = sorted(items, key=lambda item: item[0])
+        self.starts = [item[0] for item in self.items]
+
+    def active(self, t: float):
+        index = bisect.bisect_right(self.starts, t)
+        # subtitles rarely overlap, look back a little for ones still on screen
+        for item in self.items[max(0, index - 3) : index]:
+            if item[0] <= t < item[1]:
+                yield item
+
+    def __call__(self, get_frame, t):
+        frame = get_frame(t)
+        items = list(self.active(t))
+        if not items:
+            return frame
+        frame = np.array(frame, dtype=np.uint8, copy=True)
+        for _, _, overlay, x, y in items:
+            blend(frame, overlay, x, y)
+        return frame
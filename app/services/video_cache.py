@@ -0,0 +1,321 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+import psutil
+from loguru import logger
+
+from app.config import config
+from app.services import metadata, processes
+from app.utils import utils
+
+try:
+    import fcntl
+except ImportError:  # windows, sweeps are only serialized between threads
+    fcntl = None
+
+# evicting stops once the cache is this far under its budget, so a sweep
+# frees room for a few downloads instead of one
+low_watermark = 0.9
+# a part or temp file untouched for this long is a download or encode
+# nobody will finish
+part_ttl = 24 * 3600
+# downloaded materials, their normalized copies and the image clips
+prefixes = ("vid-", "norm-", "img-")
+# a pin taken on another host (storage shared over the network) can not be
+# checked against its process, it lapses when not renewed for this long
+pin_ttl = 24 * 3600
+
+# a pin belongs to a process: its host, pid and start time, a pid reused
+# after the process is gone does not keep the pin alive
+_host = socket.gethostname()
+
+_lock = threading.Lock()
+_ready = set()
+_sweeper = None
+_wake = threading.Event()
+
+
+def db_path() -> str:
+    return os.path.join(utils.storage_dir(create=True), "video_cache.db")
+
+
+def max_size() -> int:
+    # bytes the cached videos may take together, 0 keeps them all
+    return int(float(config.app.get("cache_videos_max_size", 20)) * 1024**3)
+
+
+def cache_dirs() -> List[str]:
+    """
+    The directories save_video fills: storage/cache_videos, and the
+    material_directory when it is a shared one (task directories go with
+    their task), then the normalized copies and the image clips made from
+    them.
+    """
+    dirs = [utils.storage_dir("cache_videos")]
+    material_directory = config.app.get("material_directory", "").strip()
+    if material_directory and material_directory != "task":
+        if os.path.isdir(material_directory):
+            dirs.append(material_directory)
+    dirs += [utils.storage_dir("normalized_videos"), utils.storage_dir("image_videos")]
+    return [os.path.abspath(d) for d in dirs]
+
+
+def _connect() -> sqlite3.Connection:
+    path = db_path()
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    with _lock:
+        if path not in _ready:
+            # every worker process records its uses and pins here
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, last_used REAL, uses INTEGER)"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(pins)")]
+            if columns and "host" not in columns:
+                # pins of the first layout only knew the pid, they are
+                # renewed by the tasks still running
+                conn.execute("DROP TABLE pins")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pins ("
+                "path TEXT, task_id TEXT, host TEXT, pid INTEGER, started REAL, "
+                "pinned_at REAL, PRIMARY KEY (path, task_id, host, pid))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS pins_task ON pins (task_id)")
+            _ready.add(path)
+    return conn
+
+
+def use(video_path: str):
+    """
+    Record an access of a cached video and pin it for the current task, it
+    is not evicted until the task is done. Call it before checking that the
+    file exists: a sweep never removes a pinned file, so what the check
+    finds stays there.
+    """
+    video_path = os.path.abspath(video_path)
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "INSERT INTO files VALUES (?, ?, 1) ON CONFLICT(path) "
+            "DO UPDATE SET last_used = excluded.last_used, uses = uses + 1",
+            (video_path, time.time()),
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO pins VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                video_path,
+                processes.current_task(),
+                _host,
+                os.getpid(),
+                _started(os.getpid()),
+                time.time(),
+            ),
+        )
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    start()
+
+
+def added():
+    # a new video landed, sweep soon rather than at the next interval
+    _wake.set()
+
+
+def release(task_id: str = ""):
+    task_id = task_id or processes.current_task()
+    conn = _connect()
+    try:
+        conn.execute(
+            "DELETE FROM pins WHERE task_id = ? AND host = ? AND pid = ?",
+            (task_id, _host, os.getpid()),
+        )
+    finally:
+        conn.close()
+
+
+@contextmanager
+def pinning(task_id: str):
+    # the videos a task uses are kept while it runs and released after
+    try:
+        yield
+    finally:
+        release(task_id)
+
+
+def _started(pid: int) -> float:
+    try:
+        return psutil.Process(pid).create_time()
+    except psutil.Error:
+        return 0.0
+
+
+def _alive(host: str, pid: int, started: float, pinned_at: float) -> bool:
+    if host != _host:
+        return time.time() - pinned_at < pin_ttl
+    # the same pid with another start time is a new process
+    return abs(_started(pid) - started) < 1e-3
+
+
+def _pinned(conn: sqlite3.Connection, video_path: str) -> bool:
+    rows = conn.execute(
+        "SELECT rowid, host, pid, started, pinned_at FROM pins WHERE path = ?",
+        (video_path,),
+    ).fetchall()
+    alive = False
+    for rowid, host, pid, started, pinned_at in rows:
+        if _alive(host, pid, started, pinned_at):
+            alive = True
+        else:
+            # the worker that pinned it is gone, crashed or restarted
+            conn.execute("DELETE FROM pins WHERE rowid = ?", (rowid,))
+    return alive
+
+
+def _scan():
+    """
+    (path, size, mtime) of every cached video, and removes the part and
+    temp files of downloads and encodes abandoned long ago on the way.
+    """
+    files = []
+    now = time.time()
+    for cache_dir in cache_dirs():
+        if not os.path.isdir(cache_dir):
+            continue
+        for entry in os.scandir(cache_dir):
+            if not entry.is_file() or not entry.name.startswith(prefixes):
+                continue
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(".part") or ".tmp." in entry.name:
+                    # downloads and encodes in progress keep writing to theirs
+                    if now - stat.st_mtime > part_ttl:
+                        os.remove(entry.path)
+                        metadata.forget(entry.path)
+                        logger.info(f"removed abandoned file: {entry.path}")
+                elif entry.name.endswith(".mp4"):
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+            except OSError:
+                # removed by another worker meanwhile
+                continue
+    return files
+
+
+def _forget_missing(files):
+    # the access records of videos removed by hand or never finished
+    on_disk = {video_path for video_path, _, _ in files}
+    conn = _connect()
+    try:
+        recorded = [row[0] for row in conn.execute("SELECT path FROM files")]
+        conn.executemany(
+            "DELETE FROM files WHERE path = ?",
+            [(p,) for p in recorded if p not in on_disk and not os.path.exists(p)],
+        )
+    finally:
+        conn.close()
+
+
+@contextmanager
+def _sweep_lock():
+    # one sweep at a time across all worker processes, the others skip theirs
+    if fcntl is None:
+        yield True
+        return
+    lock_path = os.path.join(utils.storage_dir("locks", create=True), "video-cache.lock")
+    with open(lock_path, "a") as handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def sweep() -> int:
+    """
+    Evict the least recently used videos that no running task has pinned
+    until the cache fits cache_videos_max_size again. Returns the bytes freed.
+    """
+    with _sweep_lock() as locked:
+        if not locked:
+            return 0
+        files = _scan()
+        _forget_missing(files)
+        budget = max_size()
+        total = sum(size for _, size, _ in files)
+        if budget <= 0 or total <= budget:
+            return 0
+
+        conn = _connect()
+        try:
+            last_used = dict(conn.execute("SELECT path, last_used FROM files").fetchall())
+            # files from before the tracking started count from when they were saved
+            files.sort(key=lambda f: last_used.get(f[0], f[2]))
+            freed, evicted = 0, 0
+            target = budget * low_watermark
+            for video_path, size, _ in files:
+                if total - freed <= target:
+                    break
+                # pins are written in their own transactions, none sneaks in
+                # between the check and the removal
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    if _pinned(conn, video_path):
+                        conn.execute("COMMIT")
+                        continue
+                    conn.execute("DELETE FROM files WHERE path = ?", (video_path,))
+                    os.remove(video_path)
+                    conn.execute("COMMIT")
+                except FileNotFoundError:
+                    conn.execute("COMMIT")
+                    continue
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                metadata.forget(video_path)
+                freed += size
+                evicted += 1
+        finally:
+            conn.close()
+
+        logger.info(
+            f"video cache: evicted {evicted} videos, freed {freed / 1024**2:.0f}MB, "
+            f"{(total - freed) / 1024**2:.0f}MB of {budget / 1024**2:.0f}MB used"
+        )
+        return freed
+
+
+def _run(interval: float):
+    while True:
+        _wake.wait(timeout=interval)
+        _wake.clear()
+        try:
+            sweep()
+        except Exception as e:
+            logger.warning(f"video cache sweep failed: {str(e)}")
+
+
+def start():
+    """
+    Start the background sweeper of this process, it runs every
+    cache_sweep_interval seconds and after new downloads.
+    """
+    global _sweeper
+    with _lock:
+        if _sweeper is not None:
+            return
+        interval = float(config.app.get("cache_sweep_interval", 600))
+        _sweeper = threading.Thread(
+            target=_run, args=(interval,), name="video-cache-sweeper", daemon=True
+        )
+        _sweeper.start()
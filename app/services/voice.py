@@ -12,12 +12,12 @@ from edge_tts import SubMaker, submaker
 from loguru import logger
 from moviepy.video.tools import subtitles
 from openai import OpenAI
-import requests
 import google.generativeai as genai
 from google.generativeai import types
 
 
 from app.config import config
+from app.services import clients
 from app.utils import utils
 
 
@@ -200,8 +200,17 @@ def openai_tts(text: str, voice_name: str, voice_rate: float, voice_file: str) -
                 logger.error("OpenAI API key not found in config")
                 return None
 
-            # Create OpenAI client
-            client = OpenAI(api_key=api_key, base_url=base_url if base_url else None)
+            # Shared OpenAI client, retries and later tasks reuse its connections
+            client = clients.client(
+                "openai",
+                lambda: OpenAI(
+                    api_key=api_key,
+                    base_url=base_url if base_url else None,
+                    http_client=clients.httpx_client(),
+                ),
+                api_key,
+                base_url,
+            )
 
             # Create SubMaker for subtitle generation
             sub_maker = SubMaker()
@@ -299,11 +308,11 @@ def openai_fm_tts(text: str, voice_name: str, voice_rate: float, voice_file: str
             }
 
             # Make request to OpenAI FM API
-            response = requests.post(
+            response = clients.session("openai_fm").post(
                 "https://www.openai.fm/api/generate",
                 headers=headers,
                 data=payload,
-                timeout=(30, 60)
+                timeout=clients.timeout(30, 60)
             )
 
             if response.status_code != 200:
@@ -382,8 +391,10 @@ def gemini_tts(text: str, voice_name: str, voice_rate: float, voice_file: str) -
                 logger.error("Gemini API key not found in config")
                 return None
 
-            # Create Gemini client
-            client = genai.Client(api_key=api_key)
+            # Shared Gemini client
+            client = clients.client(
+                "gemini", lambda: genai.Client(api_key=api_key), api_key
+            )
 
             # Create SubMaker for subtitle generation
             sub_maker = SubMaker()
@@ -0,0 +1,150 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import psutil
+from loguru import logger
+
+from app.config import config
+from app.services import governor, processes
+from app.services import state as sm
+
+# the degradation steps, in the order they kick in
+lower_resolution = "lower_resolution"
+reduce_parallelism = "reduce_parallelism"
+pause_renders = "pause_renders"
+steps = [lower_resolution, reduce_parallelism, pause_renders]
+
+# task id => the watchdog of its render
+_watchdogs: Dict[str, "Watchdog"] = {}
+_lock = threading.Lock()
+
+
+def memory_limit() -> int:
+    # the ffmpeg RAM budget when there is one, the machine otherwise
+    return governor.ram_limit() or psutil.virtual_memory().total
+
+
+def thresholds():
+    # fractions of the limit at which each step starts
+    values = config.app.get("memory_degrade_thresholds", [0.7, 0.8, 0.9])
+    return [float(v) for v in values][: len(steps)]
+
+
+def rss() -> int:
+    """
+    RSS of this worker and all of its children: the ffmpeg readers and
+    writers, the render pool workers and their ffmpeg processes.
+    """
+    process = psutil.Process()
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            # it finished between listing and sampling
+            pass
+    return total
+
+
+class Watchdog:
+    def __init__(self, task_id: str, interval: float = 1.0):
+        self.task_id = task_id
+        self.interval = interval
+        self.limit = memory_limit()
+        self.thresholds = thresholds()
+        self.level = 0
+        self.degradations = []
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"watchdog-{task_id}", daemon=True
+        )
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning(f"memory watchdog of task {self.task_id}: {str(e)}")
+
+    def sample(self):
+        used = rss()
+        level = sum(1 for t in self.thresholds if used >= t * self.limit)
+        previous, self.level = self.level, level
+        for step in steps[previous:level]:
+            self._record(step, used)
+        if level > previous:
+            gc.collect()
+        elif level < previous:
+            logger.info(
+                f"memory pressure of task {self.task_id} eased, "
+                f"{used / 1024 / 1024:.0f} MB, level {level}"
+            )
+        return used
+
+    def _record(self, step: str, used: int):
+        logger.warning(
+            f"memory pressure in task {self.task_id}: {used / 1024 / 1024:.0f} MB "
+            f"of {self.limit / 1024 / 1024:.0f} MB, {step}"
+        )
+        self.degradations.append(
+            {
+                "step": step,
+                "rss_mb": round(used / 1024 / 1024),
+                "limit_mb": round(self.limit / 1024 / 1024),
+                "time": round(time.time(), 3),
+            }
+        )
+        # kept with the task so the hardware can be sized from finished tasks
+        sm.state.update_fields(self.task_id, degradations=list(self.degradations))
+
+
+@contextmanager
+def watch(task_id: str):
+    """
+    Sample the memory of the render of task_id in the background. Past the
+    memory_degrade_thresholds the render slows down instead of running out
+    of memory: decoders open at a lower resolution, fewer parts render at
+    once, and then no new part starts until the pressure eases.
+    """
+    watchdog = Watchdog(task_id, float(config.app.get("memory_watchdog_interval", 1.0)))
+    watchdog.start()
+    with _lock:
+        _watchdogs[task_id] = watchdog
+    try:
+        yield watchdog
+    finally:
+        with _lock:
+            _watchdogs.pop(task_id, None)
+        watchdog.stop()
+
+
+def level() -> int:
+    watchdog = _watchdogs.get(processes.current_task())
+    return watchdog.level if watchdog else 0
+
+
+def decode_scale() -> float:
+    if level() < 1:
+        return 1.0
+    return float(config.app.get("memory_decode_scale", 0.5))
+
+
+def parallelism(workers: int) -> int:
+    if level() < 2:
+        return workers
+    return max(1, workers // 2)
+
+
+def paused() -> bool:
+    return level() >= 3
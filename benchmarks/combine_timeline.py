@@ -0,0 +1,65 @@
+"""
+Per-frame cost of the combined timeline as the number of clips grows.
+
+Compares the old layout of combine_videos (every clip wrapped in a
+CompositeVideoClip, batches of 3 concatenated onto the previous result)
+with the flat timeline from video.concatenate_timeline.
+
+    python benchmarks/combine_timeline.py
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from moviepy import CompositeVideoClip, VideoClip, concatenate_videoclips
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services.video import concatenate_timeline  # noqa: E402
+
+clip_duration = 0.5
+frames = 200
+size = (108, 192)
+
+
+def make_clips(count):
+    frame = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    return [
+        VideoClip(frame_function=lambda t: frame, duration=clip_duration).with_fps(30)
+        for _ in range(count)
+    ]
+
+
+def nested_timeline(clips, batch_size=3):
+    processed = None
+    for i in range(0, len(clips), batch_size):
+        batch = [CompositeVideoClip([clip]) for clip in clips[i : i + batch_size]]
+        batch_clip = batch[0] if len(batch) == 1 else concatenate_videoclips(batch)
+        if processed is None:
+            processed = batch_clip
+        else:
+            processed = concatenate_videoclips([processed, batch_clip])
+    return processed
+
+
+def per_frame_ms(timeline):
+    # sample the same number of frames spread over the whole timeline
+    times = np.linspace(0, timeline.duration - 1e-3, frames)
+    started = time.perf_counter()
+    for t in times:
+        timeline.get_frame(t)
+    return (time.perf_counter() - started) / frames * 1000
+
+
+def main():
+    print(f"{'clips':>6} {'nested ms/frame':>16} {'flat ms/frame':>14}")
+    for count in (10, 25, 50, 100, 200):
+        nested = per_frame_ms(nested_timeline(make_clips(count)))
+        flat = per_frame_ms(concatenate_timeline(make_clips(count)))
+        print(f"{count:>6} {nested:>16.3f} {flat:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
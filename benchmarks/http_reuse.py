@@ -0,0 +1,87 @@
+"""
+Connections opened for the same batch of calls: a fresh requests call
+each time (as before) against the shared sessions from app.services.clients,
+measured on a local HTTP/1.1 stand-in that counts the connections it accepts.
+
+    python benchmarks/http_reuse.py
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services import clients  # noqa: E402
+
+calls = 200
+threads = 4
+# a round trip to a real provider, the handshake is what reuse saves
+latency = 0.002
+body = b'{"videos": []}'
+
+connections = 0
+_lock = threading.Lock()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    # keep-alive, one handler instance serves one connection
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        global connections
+        with _lock:
+            connections += 1
+        super().setup()
+        # headers and body go out in two writes, real servers set this so
+        # the body does not wait for a delayed ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        time.sleep(latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(get, url):
+    global connections
+    connections = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for r in pool.map(lambda _: get(url, timeout=10), range(calls)):
+            r.raise_for_status()
+    return connections, time.perf_counter() - started
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/videos/search"
+
+    print(f"{calls} calls from {threads} threads")
+    print(f"{'client':>10} {'connections':>12} {'seconds':>8}")
+    for name, get in (
+        ("per call", requests.get),
+        ("pooled", clients.session("benchmark").get),
+    ):
+        opened, elapsed = run(get, url)
+        print(f"{name:>10} {opened:>12} {elapsed:>8.2f}")
+
+    clients.close_all()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+wrap_text on 500 character scripts: the previous word-by-word implementation
+against the current one, checking that both produce the same lines.
+
+    python benchmarks/wrap_text.py
+"""
+
+import os
+import random
+import sys
+import time
+
+from PIL import ImageFont
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.services.video import wrap_text  # noqa: E402
+from app.utils import utils  # noqa: E402
+
+font_path = os.path.join(utils.font_dir(), "UTM Kabel KT.ttf")
+font_size = 60
+max_width = 1080 * 0.9
+rounds = 20
+
+
+def legacy_wrap_text(text, max_width, font="Arial", fontsize=60):
+    font = ImageFont.truetype(font, fontsize)
+
+    def get_text_size(inner_text):
+        inner_text = inner_text.strip()
+        left, top, right, bottom = font.getbbox(inner_text)
+        return right - left, bottom - top
+
+    width, height = get_text_size(text)
+    if width <= max_width:
+        return text, height
+
+    processed = True
+
+    _wrapped_lines_ = []
+    words = text.split(" ")
+    _txt_ = ""
+    for word in words:
+        _before = _txt_
+        _txt_ += f"{word} "
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            if _txt_.strip() == word.strip():
+                processed = False
+                break
+            _wrapped_lines_.append(_before)
+            _txt_ = f"{word} "
+    _wrapped_lines_.append(_txt_)
+    if processed:
+        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
+        result = "\n".join(_wrapped_lines_).strip()
+        height = len(_wrapped_lines_) * height
+        return result, height
+
+    _wrapped_lines_ = []
+    chars = list(text)
+    _txt_ = ""
+    for word in chars:
+        _txt_ += word
+        _width, _height = get_text_size(_txt_)
+        if _width <= max_width:
+            continue
+        else:
+            _wrapped_lines_.append(_txt_)
+            _txt_ = ""
+    _wrapped_lines_.append(_txt_)
+    result = "\n".join(_wrapped_lines_).strip()
+    height = len(_wrapped_lines_) * height
+    return result, height
+
+
+def make_scripts(rng):
+    latin = "Mỗi ngày chúng ta học thêm một điều mới về thế giới xung quanh mình".split()
+    english = "the quick brown fox jumps over a lazy dog while nobody watches".split()
+    cjk = "人工智能正在改变我们生活和工作的方式每一天都有新的发现"
+    scripts = []
+    for _ in range(10):
+        words = rng.choices(latin + english, k=200)
+        scripts.append(" ".join(words)[:500])
+        scripts.append("".join(rng.choices(cjk, k=500)))
+        # double spaces and a word longer than a line
+        scripts.append(("  ".join(words[:40]) + " " + "x" * 60 + " " + " ".join(words[40:]))[:500])
+    return scripts
+
+
+def run(func, scripts):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        results = [func(s, max_width, font=font_path, fontsize=font_size) for s in scripts]
+    return (time.perf_counter() - started) / rounds / len(scripts) * 1000, results
+
+
+def main():
+    scripts = make_scripts(random.Random(1))
+    legacy_ms, expected = run(legacy_wrap_text, scripts)
+    current_ms, results = run(wrap_text, scripts)
+    mismatches = sum(1 for a, b in zip(expected, results) if a != b)
+    print(f"scripts: {len(scripts)} x 500 chars, font: {os.path.basename(font_path)}")
+    print(f"legacy  {legacy_ms:8.3f} ms/script")
+    print(f"current {current_ms:8.3f} ms/script ({legacy_ms / current_ms:.1f}x)")
+    print(f"identical results: {len(scripts) - mismatches}/{len(scripts)}")
+
+
+if __name__ == "__main__":
+    main()
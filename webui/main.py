@@ -809,6 +809,17 @@ with right_panel:
     with st.container(border=True):
         st.write(tr("Subtitle Settings"))
         params.subtitle_enabled = st.checkbox(tr("Enable Subtitles"), value=True)
+        subtitle_modes = [
+            (tr("Burn In Subtitles"), "burn"),
+            (tr("Soft Subtitle Track"), "soft"),
+        ]
+        selected_index = st.selectbox(
+            tr("Subtitle Mode"),
+            index=0,
+            options=range(len(subtitle_modes)),
+            format_func=lambda x: subtitle_modes[x][0],
+        )
+        params.subtitle_mode = subtitle_modes[selected_index][1]
         font_names = get_all_fonts()
         saved_font_name = config.ui.get("font_name", "")
         saved_font_name_index = 0